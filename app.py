@@ -1,18 +1,33 @@
+import time
+_IMPORT_START = time.perf_counter()  # 启动耗时统计的起点 (见 create_app)，需在其他导入之前
 import os
 import json
-import time
 import math
+import random
 import sqlite3
 import logging
 import requests
 import datetime
 import secrets
+import queue
+import gzip
 import hashlib
+import functools
+import tempfile
 import subprocess
+import contextlib
+import threading
+try: import fcntl
+except ImportError: fcntl = None  # Windows: 不支持多 worker 选主
+try: import brotli
+except ImportError: brotli = None  # 可选依赖，未安装时只提供 gzip
+from concurrent.futures import ThreadPoolExecutor, wait
 from flask import Flask, render_template, request, jsonify, session
 from apscheduler.schedulers.background import BackgroundScheduler
-from logging.handlers import TimedRotatingFileHandler
-from zeep import Client
+from logging.handlers import TimedRotatingFileHandler, WatchedFileHandler
+from export import iter_export, parse_time, EXPORT_TABLES, EXPORT_FORMATS
+import calc
+from calc import counter_delta, TREND_WINDOWS, HISTORY_DEFAULT_POINTS, HISTORY_MAX_POINTS
 
 # ===================== 基础配置 =====================
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -20,13 +35,19 @@ DATA_DIR = os.path.join(BASE_DIR, 'data')
 CONFIG_FILE = os.path.join(DATA_DIR, 'config.json')
 DB_FILE = os.path.join(DATA_DIR, 'monitor.db')
 LOG_FILE = os.path.join(DATA_DIR, 'nc_monitor.log')
+WSDL_CACHE_FILE = os.path.join(DATA_DIR, 'wsdl_cache.db')
+DEFAULT_WSDL_URL = "https://www.servercontrolpanel.de/WSEndUser?wsdl"
 
 last_notify_time = 0
 
-def setup_logging():
+def setup_logging(rotate=False):
+    # 多 worker 共用同一个日志文件，只能由一个进程轮转：调度 leader 使用按天轮转的处理器 (rotate=True)，
+    # 其他 worker 使用 WatchedFileHandler，文件被 leader 轮转后自动重新打开新文件
     logger = logging.getLogger('NC_Monitor')
     logger.setLevel(logging.INFO)
-    if logger.hasHandlers(): logger.handlers.clear()
+    for h in list(logger.handlers):
+        logger.removeHandler(h)
+        h.close()
     
     formatter = logging.Formatter('%(asctime)s - %(levelname)s - [%(funcName)s:%(lineno)d] - %(message)s')
     
@@ -36,44 +57,377 @@ def setup_logging():
     
     if not os.path.exists(DATA_DIR): os.makedirs(DATA_DIR)
     
-    fh = TimedRotatingFileHandler(filename=LOG_FILE, when='midnight', interval=1, backupCount=1, encoding='utf-8')
+    if rotate: fh = TimedRotatingFileHandler(filename=LOG_FILE, when='midnight', interval=1, backupCount=1, encoding='utf-8')
+    else: fh = WatchedFileHandler(filename=LOG_FILE, encoding='utf-8')
     fh.setFormatter(formatter)
     logger.addHandler(fh)
     return logger
 
-logger = setup_logging()
+# 日志处理器 (控制台 + data/ 下的日志文件) 由 create_app 配置，仅导入模块时不创建文件
+logger = logging.getLogger('NC_Monitor')
+
+def load_secret_key():
+    # 多 worker 部署时各进程必须使用同一个密钥，否则登录状态只在签发它的 worker 有效；
+    # 未设置 SECRET_KEY 时生成一次并保存到 data/secret_key
+    key = os.environ.get('SECRET_KEY')
+    if key: return key
+    path = os.path.join(DATA_DIR, 'secret_key')
+    try: fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        # 其他 worker 刚创建文件时可能还未写入内容
+        for _ in range(50):
+            with open(path, 'r') as f: key = f.read().strip()
+            if key: return key
+            time.sleep(0.1)
+        raise RuntimeError(f"{path} 为空，请删除后重启")
+    key = secrets.token_hex(32)
+    with os.fdopen(fd, 'w') as f: f.write(key)
+    return key
 
 app = Flask(__name__)
-app.secret_key = os.environ.get('SECRET_KEY', secrets.token_hex(32))
+
+# ===================== 运行指标 (Prometheus) =====================
+# 轻量的进程内指标注册表，/metrics 以 Prometheus 文本格式输出，无需额外依赖
+class Metrics:
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._families = {}  # name -> {'type', 'help', 'values': {labels: value | [bucket counts..., sum, count]}}
+
+    def describe(self, name, kind, text):
+        self._families[name] = {'type': kind, 'help': text, 'values': {}}
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._families[name]['values']
+            h = values.get(key)
+            if h is None: h = values[key] = [0] * (len(self.BUCKETS) + 2)
+            for i, b in enumerate(self.BUCKETS):
+                if value <= b: h[i] += 1
+            h[-2] += value
+            h[-1] += 1
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._families[name]['values']
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._families[name]['values'][tuple(sorted(labels.items()))] = value
+
+    def replace(self, name, values):
+        # 整体替换一个 gauge 族 (例如服务器被移除后不再输出旧标签)
+        with self._lock:
+            self._families[name]['values'] = {tuple(sorted(labels.items())): v for labels, v in values}
+
+    def timed(self, name, **labels):
+        def deco(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try: return fn(*args, **kwargs)
+                finally: self.observe(name, time.perf_counter() - start, **labels)
+            return wrapper
+        return deco
+
+    @staticmethod
+    def _labels(key, extra=()):
+        items = list(key) + list(extra)
+        if not items: return ''
+        esc = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{k}="{esc(v)}"' for k, v in items) + '}'
+
+    def render(self):
+        out = []
+        with self._lock:
+            for name, fam in self._families.items():
+                out.append(f"# HELP {name} {fam['help']}")
+                out.append(f"# TYPE {name} {fam['type']}")
+                for key, v in fam['values'].items():
+                    if fam['type'] != 'histogram':
+                        out.append(f"{name}{self._labels(key)} {v}")
+                        continue
+                    for b, count in zip(self.BUCKETS, v):
+                        out.append(f"{name}_bucket{self._labels(key, [('le', b)])} {count}")
+                    out.append(f"{name}_bucket{self._labels(key, [('le', '+Inf')])} {v[-1]}")
+                    out.append(f"{name}_sum{self._labels(key)} {v[-2]}")
+                    out.append(f"{name}_count{self._labels(key)} {v[-1]}")
+        return "\n".join(out) + "\n"
+
+metrics = Metrics()
+metrics.describe('nc_monitor_cycle_seconds', 'histogram', 'run_monitor_task 总耗时')
+metrics.describe('nc_monitor_phase_seconds', 'histogram', '检测周期各阶段耗时 (soap / qb / db / vertex / notify / stats)')
+metrics.describe('nc_monitor_server_phase_seconds', 'histogram', '单台服务器各阶段耗时 (qb: 流量与种子同步, policy: 限速 / 恢复策略)')
+metrics.describe('nc_monitor_last_cycle_timestamp', 'gauge', '最近一次检测完成的时间戳')
+metrics.describe('nc_qb_request_seconds', 'histogram', 'qBittorrent API 请求耗时')
+metrics.describe('nc_qb_request_errors_total', 'counter', 'qBittorrent API 请求失败次数 (kind: connect / http)')
+metrics.describe('nc_qb_logins_total', 'counter', 'qBittorrent 登录次数')
+metrics.describe('nc_db_query_seconds', 'histogram', '统计查询耗时')
+metrics.describe('nc_server_throttled', 'gauge', '服务器当前是否限速 (1 = 限速)')
+metrics.describe('nc_notify_total', 'counter', '通知投递结果 (result: sent / failed / dropped)')
+metrics.describe('nc_sse_subscribers', 'gauge', '当前 /api/events 订阅连接数')
+metrics.describe('nc_startup_seconds', 'gauge', '进程启动各阶段耗时 (import / setup / db / scheduler)')
+metrics.describe('nc_scheduler_leader', 'gauge', '本进程是否运行检测调度 (多 worker 部署时只有一个为 1)')
 
 # ===================== 数据库初始化 =====================
+def _backfill_server_health(conn):
+    conn.execute("DELETE FROM server_health")
+    conn.execute("""INSERT INTO server_health (server_name, closed_low)
+                    SELECT server_name, SUM(duration) FROM state_events
+                    WHERE state='low' AND end_time IS NOT NULL GROUP BY server_name""")
+
+def _import_restore_files(conn):
+    # 导入旧版 restore_{ip}.json (与数据库同目录)，按配置中的 IP 找到服务器名称；损坏的文件仍视为限速标记
+    # 文件在迁移事务提交后才删除 (返回给 init_db 的提交后回调)，回滚时旧文件仍保留
+    data_dir = os.path.dirname(os.path.abspath(DB_FILE))
+    try:
+        with open(os.path.join(data_dir, 'config.json'), 'r', encoding='utf-8') as f:
+            names = {s['ip']: s['name'] for s in json.load(f).get('servers', [])}
+    except Exception: names = {}
+    imported = []
+    for fn in os.listdir(data_dir):
+        if not (fn.startswith('restore_') and fn.endswith('.json')): continue
+        name = names.get(fn[len('restore_'):-len('.json')])
+        if not name: continue
+        path = os.path.join(data_dir, fn)
+        try:
+            with open(path, 'r', encoding='utf-8') as f: limits = json.load(f)
+        except Exception: limits = {}
+        conn.executemany("INSERT OR IGNORE INTO torrent_restore (server_name, hash, up_limit) VALUES (?, ?, ?)",
+                         [(name, h, int(limit)) for h, limit in limits.items()])
+        conn.execute("INSERT OR IGNORE INTO restore_marks (server_name, since) VALUES (?, ?)", (name, os.path.getmtime(path)))
+        imported.append(path)
+    def remove_files():
+        for path in imported:
+            try: os.remove(path)
+            except OSError as e: logger.warning(f"删除已导入的 {os.path.basename(path)} 失败: {e}")
+    return remove_files
+
+def _backfill_traffic_daily(conn):
+    # 由 traffic_log 重建按日汇总；carry_* 为当天第一条样本相对前一条样本 (通常在前一天) 的增量
+    name, prev, day_row = None, None, None
+    def flush():
+        if day_row: conn.execute("INSERT OR REPLACE INTO traffic_daily VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (name, *day_row))
+    # 逐行读取游标 (不一次性载入整表)；写入的是另一张表，不影响读游标
+    rows = conn.cursor().execute("SELECT server_name, timestamp, up_total, dl_total FROM traffic_log ORDER BY server_name, timestamp")
+    for n, ts, u, d in rows:
+        if not (u and d): continue
+        if n != name:
+            flush()
+            name, prev, day_row = n, None, None
+        day = datetime.date.fromtimestamp(ts).isoformat()
+        du, dd = (counter_delta(prev[0], u), counter_delta(prev[1], d)) if prev else (0, 0)
+        if day_row and day_row[0] == day:
+            day_row = [day, day_row[1] + du, day_row[2] + dd, day_row[3], day_row[4], u, d, day_row[7], ts]
+        else:
+            flush()
+            day_row = [day, du, dd, du, dd, u, d, ts, ts]
+        prev = (u, d)
+    flush()
+
+# 版本化迁移：每个版本是一组 SQL 语句 (或接收 conn 的函数)，按顺序在事务中执行，
+# 已有的 monitor.db 会根据 schema_version 原地升级。只允许追加，不要修改已发布的版本。
+DB_MIGRATIONS = [
+    # v1: 基础表
+    [
+        '''CREATE TABLE IF NOT EXISTS traffic_log
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            server_name TEXT, timestamp REAL, up_total INTEGER, dl_total INTEGER, state TEXT)''',
+        '''CREATE TABLE IF NOT EXISTS state_events
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            server_name TEXT, start_time REAL, end_time REAL, state TEXT, duration REAL)''',
+    ],
+    # v2: 按 server_name + 时间 查询的复合索引
+    [
+        "CREATE INDEX IF NOT EXISTS idx_traffic_server_ts ON traffic_log (server_name, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_events_server_end ON state_events (server_name, end_time)",
+        "CREATE INDEX IF NOT EXISTS idx_events_server_state_end ON state_events (server_name, state, end_time)",
+        "ANALYZE",
+    ],
+    # v3: 按日流量汇总 (由 log_to_db 增量维护)
+    [
+        '''CREATE TABLE IF NOT EXISTS traffic_daily
+           (server_name TEXT NOT NULL, day TEXT NOT NULL,
+            up_delta INTEGER NOT NULL, dl_delta INTEGER NOT NULL,
+            carry_up INTEGER NOT NULL, carry_dl INTEGER NOT NULL,
+            last_up INTEGER NOT NULL, last_dl INTEGER NOT NULL,
+            first_ts REAL NOT NULL, last_ts REAL NOT NULL,
+            PRIMARY KEY (server_name, day))''',
+        _backfill_traffic_daily,
+    ],
+    # v4: 压缩任务的进度水位 (每个层级已处理到的时间点)
+    [
+        "CREATE TABLE IF NOT EXISTS compaction_state (tier TEXT PRIMARY KEY, done_until REAL NOT NULL)",
+    ],
+    # v5: 已结束限速事件的累计时长 (替代对 state_events 全量 SUM)；进行中事件的时长改为读取时计算
+    [
+        "CREATE TABLE IF NOT EXISTS server_health (server_name TEXT PRIMARY KEY, closed_low REAL NOT NULL DEFAULT 0)",
+        _backfill_server_health,
+        "UPDATE state_events SET duration=NULL WHERE end_time IS NULL",
+    ],
+    # v6: 待发送 / 待重试的通知 (进程重启后继续投递)
+    [
+        '''CREATE TABLE IF NOT EXISTS notify_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, channel TEXT NOT NULL, payload TEXT NOT NULL,
+            created REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, next_try REAL NOT NULL, last_error TEXT)''',
+        "CREATE INDEX IF NOT EXISTS idx_outbox_next ON notify_outbox(next_try)",
+    ],
+    # v7: 限速期间被修改的种子原始上传限速与「限速中」标记 (替代 data/restore_{ip}.json)
+    [
+        '''CREATE TABLE IF NOT EXISTS torrent_restore (
+            server_name TEXT NOT NULL, hash TEXT NOT NULL, up_limit INTEGER NOT NULL,
+            PRIMARY KEY (server_name, hash)) WITHOUT ROWID''',
+        "CREATE TABLE IF NOT EXISTS restore_marks (server_name TEXT PRIMARY KEY, since REAL NOT NULL)",
+        _import_restore_files,
+    ],
+    # v8: 非调度进程 (gunicorn 其他 worker) 转交给调度进程执行的手动检测请求
+    [
+        "CREATE TABLE IF NOT EXISTS run_requests (id INTEGER PRIMARY KEY AUTOINCREMENT, servers TEXT NOT NULL, created REAL NOT NULL)",
+    ],
+    # v9: 事件导出按 (server_name, start_time) 顺序流式读取，避免临时排序
+    [
+        "CREATE INDEX IF NOT EXISTS idx_events_server_start ON state_events (server_name, start_time)",
+    ],
+]
+
 def init_db():
     if not os.path.exists(DATA_DIR): os.makedirs(DATA_DIR)
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS traffic_log
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  server_name TEXT, timestamp REAL, up_total INTEGER, dl_total INTEGER, state TEXT)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS state_events
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  server_name TEXT, start_time REAL, end_time REAL, state TEXT, duration REAL)''')
-    conn.commit()
-    conn.close()
+    conn = sqlite3.connect(DB_FILE, isolation_level=None, timeout=30)
+    try:
+        # WAL: 调度线程写入时不阻塞面板读取
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+        while True:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT version FROM schema_version").fetchone()
+                if row is None: conn.execute("INSERT INTO schema_version (version) VALUES (0)")
+                version = row[0] if row else 0
+                if version >= len(DB_MIGRATIONS):
+                    conn.execute("COMMIT")
+                    break
+                # 迁移函数可返回提交后回调 (如删除已导入的旧文件)，仅在 COMMIT 成功后执行
+                after_commit = []
+                for step in DB_MIGRATIONS[version]:
+                    if callable(step): after_commit.append(step(conn))
+                    else: conn.execute(step)
+                conn.execute("UPDATE schema_version SET version=?", (version + 1,))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            for callback in after_commit:
+                if callback: callback()
+            logger.info(f"数据库结构已升级至 v{version + 1}")
+    finally:
+        conn.close()
+
+# ===================== 数据库访问层 =====================
+# 写：单个长连接 + 锁，每个检测周期的全部写入在一个事务中提交 (WAL + synchronous=NORMAL)
+# 读：每个线程复用自己的只读连接 (Flask 请求线程 / 调度线程)
+class Database:
+    def __init__(self, path):
+        self.path = path
+        self._write_lock = threading.Lock()
+        self._writer = None
+        self._local = threading.local()
+
+    def read(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            self._local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def write(self):
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+                self._writer.execute("PRAGMA synchronous=NORMAL")
+            conn = self._writer
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
 
-init_db()
+db = Database(DB_FILE)
 
 # ===================== 工具函数 =====================
+# 只读配置快照：读取方共享同一份对象 (跨线程安全)，需要修改时先 thaw() 出可变副本
+class FrozenDict(dict):
+    def _readonly(self, *args, **kwargs): raise TypeError("配置快照只读，请先 thaw() 后再修改")
+    __setitem__ = __delitem__ = update = pop = popitem = setdefault = clear = _readonly
+
+def freeze(obj):
+    if isinstance(obj, dict): return FrozenDict((k, freeze(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)): return tuple(freeze(v) for v in obj)
+    return obj
+
+def thaw(obj):
+    if isinstance(obj, dict): return {k: thaw(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)): return [thaw(v) for v in obj]
+    return obj
+
+# 配置常驻内存，仅在文件 inode / mtime / 大小变化时重新解析；写入走临时文件 + 原子替换
+class ConfigStore:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._sig = None
+        self._snapshot = FrozenDict()
+
+    def _signature(self):
+        try: st = os.stat(self.path)
+        except FileNotFoundError: return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def get(self):
+        if self._signature() == self._sig: return self._snapshot
+        with self._lock:
+            sig = self._signature()
+            if sig != self._sig:
+                if sig is None:
+                    self._snapshot = FrozenDict()
+                else:
+                    try:
+                        with open(self.path, 'r', encoding='utf-8') as f: self._snapshot = freeze(json.load(f))
+                    except Exception as e:
+                        # 保留上一份有效配置，文件再次变化时重试
+                        logger.error(f"加载配置文件失败: {e}")
+                self._sig = sig
+            return self._snapshot
+
+    def save(self, data):
+        with self._lock:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.config.', suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, indent=2, ensure_ascii=False)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, self.path)
+            except Exception:
+                if os.path.exists(tmp): os.remove(tmp)
+                raise
+            self._snapshot = freeze(data)
+            self._sig = self._signature()
+
+config_store = ConfigStore(CONFIG_FILE)
+
 def load_config():
-    try:
-        if not os.path.exists(CONFIG_FILE): return {}
-        with open(CONFIG_FILE, 'r', encoding='utf-8') as f: return json.load(f)
-    except Exception as e:
-        logger.error(f"加载配置文件失败: {e}")
-        return {}
+    return config_store.get()
 
 def save_config_file(data):
     try:
-        with open(CONFIG_FILE, 'w', encoding='utf-8') as f: json.dump(data, f, indent=2, ensure_ascii=False)
+        config_store.save(data)
         logger.info("配置文件已更新并保存")
     except Exception as e:
         logger.error(f"保存配置文件失败: {e}")
@@ -86,149 +440,451 @@ def format_duration(seconds):
     m = int((seconds % 3600) // 60)
     return f"{h}h{m}m"
 
-def log_to_db(name, state, up_total, dl_total):
+def update_traffic_daily(c, name, ts, up_total, dl_total):
+    day = datetime.date.fromtimestamp(ts).isoformat()
+    c.execute("SELECT day, last_up, last_dl FROM traffic_daily WHERE server_name=? ORDER BY day DESC LIMIT 1", (name,))
+    last = c.fetchone()
+    du, dd = (counter_delta(last[1], up_total), counter_delta(last[2], dl_total)) if last else (0, 0)
+    if last and last[0] == day:
+        c.execute("UPDATE traffic_daily SET up_delta=up_delta+?, dl_delta=dl_delta+?, last_up=?, last_dl=?, last_ts=? WHERE server_name=? AND day=?",
+                  (du, dd, up_total, dl_total, ts, name, day))
+    else:
+        c.execute("INSERT OR REPLACE INTO traffic_daily VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (name, day, du, dd, du, dd, up_total, dl_total, ts, ts))
+
+def log_to_db(c, name, state, up_total, dl_total, now=None):
     state_change = False
-    try:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        now = time.time()
+    now = now or time.time()
 
-        if (up_total and dl_total):
-            c.execute("INSERT INTO traffic_log (server_name, timestamp, up_total, dl_total, state) VALUES (?, ?, ?, ?, ?)",
-                    (name, now, up_total, dl_total, state))
-        
-        c.execute("SELECT id, state, start_time FROM state_events WHERE server_name=? AND end_time IS NULL ORDER BY id DESC LIMIT 1", (name,))
-        last_event = c.fetchone()
-        
-        if last_event:
-            last_id, last_state, start_time = last_event
-            duration = now - start_time
-            if last_state != state:
-                logger.info(f"[{name}] 状态变更: {last_state} -> {state}")
-                c.execute("UPDATE state_events SET end_time=?, duration=? WHERE id=?", (now, duration, last_id))
-                c.execute("INSERT INTO state_events (server_name, start_time, state) VALUES (?, ?, ?)", (name, now, state))
-                state_change = True
-            else:
-                c.execute("UPDATE state_events SET duration=? WHERE id=?", (duration, last_id))
-        else:
+    if (up_total and dl_total):
+        c.execute("INSERT INTO traffic_log (server_name, timestamp, up_total, dl_total, state) VALUES (?, ?, ?, ?, ?)",
+                (name, now, up_total, dl_total, state))
+        update_traffic_daily(c, name, now, up_total, dl_total)
+    
+    c.execute("SELECT id, state, start_time FROM state_events WHERE server_name=? AND end_time IS NULL ORDER BY id DESC LIMIT 1", (name,))
+    last_event = c.fetchone()
+    
+    if last_event:
+        last_id, last_state, start_time = last_event
+        duration = now - start_time
+        # 状态未变化时不写库：进行中事件的时长由 now - start_time 计算，只在事件结束时落盘
+        if last_state != state:
+            logger.info(f"[{name}] 状态变更: {last_state} -> {state}")
+            c.execute("UPDATE state_events SET end_time=?, duration=? WHERE id=?", (now, duration, last_id))
             c.execute("INSERT INTO state_events (server_name, start_time, state) VALUES (?, ?, ?)", (name, now, state))
-            
-        conn.commit()
-        conn.close()
-        return state_change
+            if last_state == 'low':
+                c.execute("""INSERT INTO server_health (server_name, closed_low) VALUES (?, ?)
+                             ON CONFLICT(server_name) DO UPDATE SET closed_low = closed_low + excluded.closed_low""", (name, duration))
+            state_change = True
+    else:
+        c.execute("INSERT INTO state_events (server_name, start_time, state) VALUES (?, ?, ?)", (name, now, state))
+    return state_change
+
+def apply_restore(c, name, restore):
+    if restore.get('clear'):
+        c.execute("DELETE FROM torrent_restore WHERE server_name=?", (name,))
+        c.execute("DELETE FROM restore_marks WHERE server_name=?", (name,))
+        return
+    if restore.get('add'):
+        c.executemany("INSERT OR IGNORE INTO torrent_restore (server_name, hash, up_limit) VALUES (?, ?, ?)",
+                      [(name, h, limit) for h, limit in restore['add'].items()])
+    if restore.get('mark'):
+        c.execute("INSERT OR IGNORE INTO restore_marks (server_name, since) VALUES (?, ?)", (name, time.time()))
+
+def record_cycle(results):
+    # 整个周期的样本与状态变更在同一个事务中提交，返回发生状态变更的服务器
+    changed = []
+    try:
+        with db.write() as conn:
+            c = conn.cursor()
+            for res in results:
+                if log_to_db(c, res['name'], res['state'], res['up'], res['dl'], res.get('ts')): changed.append(res['name'])
     except Exception as e:
         logger.error(f"数据库写入错误: {e}")
+        return []
+    return changed
+
+LOG_TAIL_MAX_LINES = 5000
+LOG_READ_MAX_BYTES = 2 * 1024 * 1024   # 单次请求最多读取/扫描的字节数，保证内存占用有上限
+LOG_LEVELS = {b'DEBUG': 10, b'INFO': 20, b'WARNING': 30, b'ERROR': 40, b'CRITICAL': 50}
+
+def log_line_filter(level=None, server=None):
+    # 返回按行过滤的函数；日志格式: 时间 - 级别 - [函数:行号] - 消息
+    min_level = LOG_LEVELS.get((level or '').upper().encode(), 0)
+    tag = f"[{server}]".encode('utf-8') if server else None
+    if not min_level and not tag: return None
+    def match(line):
+        if min_level:
+            parts = line.split(b' - ', 2)
+            if len(parts) < 3 or LOG_LEVELS.get(parts[1], 0) < min_level: return False
+        return tag is None or tag in line
+    return match
+
+def tail_log_lines(f, end, n, match=None, block=65536):
+    # 从 end 处向前按块读取，直到凑满 n 行 (或扫描字节数达到上限)
+    lines, pos, rest = [], end, b''
+    while pos > 0 and len(lines) < n and end - pos < LOG_READ_MAX_BYTES:
+        size = min(block, pos)
+        pos -= size
+        f.seek(pos)
+        parts = (f.read(size) + rest).split(b'\n')
+        rest = parts[0]
+        for line in reversed(parts[1:]):
+            if line and (match is None or match(line)):
+                lines.append(line)
+                if len(lines) >= n: break
+    if pos == 0 and rest and len(lines) < n and (match is None or match(rest)): lines.append(rest)
+    lines.reverse()
+    return lines
+
+def gzip_response(resp, min_size=1024):
+    if 'gzip' not in request.headers.get('Accept-Encoding', '') or resp.direct_passthrough: return resp
+    data = resp.get_data()
+    if len(data) < min_size: return resp
+    resp.set_data(gzip.compress(data, compresslevel=5))
+    resp.headers['Content-Encoding'] = 'gzip'
+    resp.headers['Vary'] = 'Accept-Encoding'
+    return resp
+
+def pick_encoding():
+    # 按 Accept-Encoding 选择压缩格式：br (已安装 brotli 时) 优先于 gzip
+    accept = request.accept_encodings
+    if brotli and accept['br']: return 'br'
+    if accept['gzip']: return 'gzip'
+    return None
+
+def compress_body(data, encoding):
+    if encoding == 'br': return brotli.compress(data, quality=9)
+    return gzip.compress(data, compresslevel=9)
 
 # ===================== 数据计算逻辑 (包含趋势) =====================
-def calculate_traffic(conn, name):
-    now = datetime.datetime.now()
-    m_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0).timestamp()
-    t_start = now.replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
-    c = conn.cursor()
-    c.execute("SELECT timestamp, up_total, dl_total FROM traffic_log WHERE server_name=? AND timestamp >= ? ORDER BY timestamp ASC", (name, m_start))
-    rows = c.fetchall()
-    
-    cur_u, cur_d = 0, 0
-    u_day, d_day, u_mon, d_mon = 0, 0, 0, 0
-    
-    if rows:
-        cur_u, cur_d = rows[-1][1], rows[-1][2]
-        c.execute("SELECT MIN(timestamp) FROM traffic_log WHERE server_name=?", (name,))
-        first_ts = c.fetchone()[0] or m_start
-        eff_start = max(m_start, first_ts)
-        delta_days = (now.timestamp() - eff_start) / 86400
-        eff_days = max(1, math.ceil(delta_days))
-        
-        prev_u, prev_d = rows[0][1], rows[0][2]
-        for i in range(1, len(rows)):
-            ts, u, d = rows[i]
-            du, dd = u - prev_u, d - prev_d
-            if du < 0: du = u 
-            if dd < 0: dd = d
-            u_mon += du; d_mon += dd
-            if ts >= t_start: u_day += du; d_day += dd
-            prev_u, prev_d = u, d
-            
-        return u_day, d_day, u_mon, d_mon, cur_u, cur_d, u_mon/eff_days, d_mon/eff_days
-    return 0,0,0,0,0,0,0,0
+# 纯计算与查询函数在 calc.py (只依赖标准库，工具脚本可直接导入)，这里包装上查询耗时指标
+calculate_traffic = metrics.timed('nc_db_query_seconds', query='calculate_traffic')(calc.calculate_traffic)
+calculate_health = metrics.timed('nc_db_query_seconds', query='calculate_health')(calc.calculate_health)
+get_daily_trends = metrics.timed('nc_db_query_seconds', query='get_daily_trends')(calc.get_daily_trends)
+get_history = metrics.timed('nc_db_query_seconds', query='get_history')(calc.get_history)
 
-def calculate_health(conn, name):
-    now = time.time()
-    today = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
-    c = conn.cursor()
-    
-    c.execute("SELECT state, start_time FROM state_events WHERE server_name=? AND end_time IS NULL ORDER BY id DESC LIMIT 1", (name,))
-    curr = c.fetchone()
-    state = curr[0] if curr else 'unknown'
-    dur = (now - curr[1]) if curr else 0
-    
-    c.execute("SELECT start_time, end_time FROM state_events WHERE server_name=? AND state='low' AND (end_time >= ? OR end_time IS NULL)", (name, today))
-    t_day = sum([min(end or now, now) - max(start, today) for start, end in c.fetchall() if min(end or now, now) > max(start, today)])
-    
-    c.execute("SELECT MIN(timestamp) FROM traffic_log WHERE server_name=?", (name,))
-    first = c.fetchone()
-    if first and first[0]:
-        days_float = (now - first[0]) / 86400
-        days = max(1, math.ceil(days_float))
-    else:
-        days = 1
-    
-    c.execute("SELECT SUM(duration) FROM state_events WHERE server_name=? AND state='low' AND end_time IS NOT NULL", (name,))
-    db_low = c.fetchone()[0] or 0
-    all_low = db_low
-    if state == 'low': all_low += dur
-    avg_daily = all_low / days
-    
-    return state, dur, t_day, avg_daily
+# ===================== 数据保留与压缩 =====================
+# traffic_log 分层降采样：最近 raw_days 天保留原始样本，hourly_days 天内按小时、更早的按天。
+# 每个时间桶保留首尾两条样本，以及计数器归零前后的两条样本，因此按 counter_delta 计算的
+# 任意区间增量与原始数据完全一致。state_events 不做处理。
+def _compact_keep_ids(rows, bucket_of):
+    keep = set()
+    prev, prev_bucket = None, None
+    for row in rows:
+        _id, ts, u, d = row
+        bucket = bucket_of(ts)
+        if bucket != prev_bucket:
+            keep.add(_id)
+            if prev: keep.add(prev[0])
+        elif u < prev[2] or d < prev[3]:
+            keep.add(prev[0]); keep.add(_id)
+        prev, prev_bucket = row, bucket
+    if prev: keep.add(prev[0])
+    return keep
+
+def _hour_bucket(ts): return int(ts // 3600)
+def _day_bucket(ts): return datetime.date.fromtimestamp(ts).toordinal()
+
+def _local_midnight(ts):
+    return datetime.datetime.combine(datetime.date.fromtimestamp(ts), datetime.time.min).timestamp()
 
-def get_daily_trends(conn, server_list):
-    dates = []
-    trends = {}
-    today = datetime.date.today()
+def _compact_tier(conn, tier, until, bucket_of):
+    row = conn.execute("SELECT done_until FROM compaction_state WHERE tier=?", (tier,)).fetchone()
+    since = row[0] if row else 0
+    if until <= since: return 0
+    deleted = 0
+    names = [n for (n,) in conn.execute("SELECT DISTINCT server_name FROM traffic_daily")]
+    for name in names:
+        rows = conn.execute("SELECT id, timestamp, up_total, dl_total FROM traffic_log WHERE server_name=? AND timestamp >= ? AND timestamp < ? ORDER BY timestamp",
+                            (name, since, until)).fetchall()
+        keep = _compact_keep_ids(rows, bucket_of)
+        drop = [(r[0],) for r in rows if r[0] not in keep]
+        if drop:
+            conn.executemany("DELETE FROM traffic_log WHERE id=?", drop)
+            deleted += len(drop)
+        conn.commit()
+    conn.execute("INSERT OR REPLACE INTO compaction_state (tier, done_until) VALUES (?, ?)", (tier, until))
+    conn.commit()
+    return deleted
+
+def run_compaction(config=None):
+    conf = (config if config is not None else load_config()).get("retention_config", {})
+    if not conf.get("enabled", True): return None
+    raw_days = float(conf.get("raw_days", 14))
+    hourly_days = float(conf.get("hourly_days", 180))
+    if raw_days <= 0: return None
+
+    started = time.time()
+    conn = sqlite3.connect(DB_FILE, timeout=30)
+    try:
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        size_before = conn.execute("PRAGMA page_count").fetchone()[0] * page_size
+        now = time.time()
+        deleted = 0
+        if hourly_days > raw_days:
+            deleted += _compact_tier(conn, 'hourly', (now - raw_days * 86400) // 3600 * 3600, _hour_bucket)
+            deleted += _compact_tier(conn, 'daily', _local_midnight(now - hourly_days * 86400), _day_bucket)
+        else:
+            deleted += _compact_tier(conn, 'daily', _local_midnight(now - raw_days * 86400), _day_bucket)
+
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            # 首次运行：切换为增量回收模式，需要一次完整 VACUUM
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+        elif deleted:
+            conn.execute("PRAGMA incremental_vacuum")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        size_after = conn.execute("PRAGMA page_count").fetchone()[0] * page_size
+    finally:
+        conn.close()
+    report = {'rows_deleted': deleted, 'bytes_reclaimed': max(0, size_before - size_after), 'size': size_after, 'seconds': round(time.time() - started, 1)}
+    logger.info(f"数据压缩完成: 删除 {deleted} 条样本, 回收 {report['bytes_reclaimed'] / 1024 / 1024:.1f} MB, 当前 {size_after / 1024 / 1024:.1f} MB ({report['seconds']}s)")
+    return report
+
+# ===================== 统计快照 =====================
+def build_stats(is_admin, days=7):
+    cfg = load_config()
+    servers = cfg.get("servers", [])
+    conn = db.read()
+    res = []
+    summ = {'total': 0, 'high': 0, 'low': 0, 'offline': 0}
     
-    for i in range(6, -1, -1):
-        d = today - datetime.timedelta(days=i)
-        dates.append(d.strftime('%m-%d'))
+    for s in servers:
+        n = s['name']
+        u_d, d_d, u_m, d_m, c_u, c_d, u_avg, d_avg = calculate_traffic(conn, n)
+        st, dur, t_day, t_avg = calculate_health(conn, n)
         
-    for s in server_list:
-        name = s['name']
-        trends[name] = {'health': [], 'traffic': []}
-        start_7d = (datetime.datetime.now() - datetime.timedelta(days=7)).timestamp()
-        c = conn.cursor()
-        c.execute("SELECT timestamp, up_total, dl_total FROM traffic_log WHERE server_name=? AND timestamp >= ? ORDER BY timestamp ASC", (name, start_7d))
-        logs = c.fetchall()
-        c.execute("SELECT start_time, end_time FROM state_events WHERE server_name=? AND state='low' AND (end_time >= ? OR end_time IS NULL)", (name, start_7d))
-        events = c.fetchall()
+        summ['total'] += 1
+        if st == 'unknown': summ['offline'] += 1
+        else: summ[st] += 1
         
-        for i in range(6, -1, -1):
-            target_date = today - datetime.timedelta(days=i)
-            day_start = datetime.datetime.combine(target_date, datetime.time.min).timestamp()
-            day_end = datetime.datetime.combine(target_date, datetime.time.max).timestamp()
-            
-            day_logs = [l for l in logs if day_start <= l[0] <= day_end]
-            if day_logs:
-                daily_sum = 0
-                prev_total = day_logs[0][1] + day_logs[0][2]
-                for j in range(1, len(day_logs)):
-                    curr_total = day_logs[j][1] + day_logs[j][2]
-                    diff = curr_total - prev_total
-                    if diff >= 0: daily_sum += diff
-                    else: daily_sum += curr_total
-                    prev_total = curr_total
-                trends[name]['traffic'].append(round(daily_sum / 1024 / 1024 / 1024, 2))
-            else:
-                trends[name]['traffic'].append(0)
-            
-            day_throttled = 0
-            for start, end in events:
-                e_end = end if end else time.time()
-                overlap_start = max(start, day_start)
-                overlap_end = min(e_end, day_end)
-                if overlap_end > overlap_start:
-                    day_throttled += (overlap_end - overlap_start)
-            trends[name]['health'].append(round(day_throttled / 3600, 1))
+        obj = {
+            'name': n, 'status': st,
+            'traffic': { 'qb_current_up': c_u, 'qb_current_dl': c_d, 'up_today': u_d, 'dl_today': d_d, 'up_month': u_m, 'dl_month': d_m, 'up_daily_avg': u_avg, 'dl_daily_avg': d_avg },
+            'health': { 'current_duration': dur, 'today_throttled': t_day, 'avg_daily_throttled': t_avg }
+        }
+        if is_admin: obj['ip'] = s['ip']
+        res.append(obj)
+    
+    trend_dates, trends = get_daily_trends(conn, servers, days)
+    return {
+        'servers': res, 
+        'summary': summ, 
+        'is_admin': is_admin, 
+        'last_updated': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'trends': {'dates': trend_dates, 'data': trends}
+    }
+
+# /api/stats_advanced 的 fields= 可选项，以及 compact=1 时各列的顺序
+STATS_FIELDS = ('summary', 'status', 'traffic', 'health', 'trends')
+STATS_ALL_FIELDS = frozenset(STATS_FIELDS)
+SUMMARY_KEYS = ('total', 'high', 'low', 'offline')
+TRAFFIC_KEYS = ('qb_current_up', 'qb_current_dl', 'up_today', 'dl_today', 'up_month', 'dl_month', 'up_daily_avg', 'dl_daily_avg')
+HEALTH_KEYS = ('current_duration', 'today_throttled', 'avg_daily_throttled')
+
+def project_stats(data, fields, compact=False):
+    # 只保留 fields 中的字段；compact 时改为短键 + 列表布局，列名见 "k"，小数取整
+    per_server = [f for f in ('status', 'traffic', 'health') if f in fields]
+    if not compact:
+        out = {'is_admin': data['is_admin'], 'last_updated': data['last_updated']}
+        if 'summary' in fields: out['summary'] = data['summary']
+        if per_server:
+            keep = {'name', 'ip', *per_server}
+            out['servers'] = [{k: v for k, v in s.items() if k in keep} for s in data['servers']]
+        if 'trends' in fields: out['trends'] = data['trends']
+        return out
+
+    out = {'a': data['is_admin'], 'u': data['last_updated'], 'k': {}}
+    if 'summary' in fields:
+        out['k']['m'] = SUMMARY_KEYS
+        out['m'] = [data['summary'][k] for k in SUMMARY_KEYS]
+    if per_server:
+        cols = [(None, ('name', 'ip') if data['is_admin'] else ('name',))]
+        if 'status' in fields: cols.append((None, ('status',)))
+        if 'traffic' in fields: cols.append(('traffic', TRAFFIC_KEYS))
+        if 'health' in fields: cols.append(('health', HEALTH_KEYS))
+        out['k']['s'] = [k for _, keys in cols for k in keys]
+        out['s'] = [[round(v) if isinstance(v, float) else v for v in ((s[g] if g else s)[k] for g, keys in cols for k in keys)]
+                    for s in data['servers']]
+    if 'trends' in fields:
+        trends = data['trends']['data']
+        names = list(trends)
+        out['t'] = {'d': data['trends']['dates'], 'n': names,
+                    'h': [trends[n]['health'] for n in names], 'tr': [trends[n]['traffic'] for n in names]}
+    return out
+
+# 数据只在每个检测周期后变化：按 (是否管理员, 趋势天数) 缓存序列化后的响应与 ETag，
+# 周期结束时预先生成默认视图，请求开销不再随打开面板的人数增长
+class StatsSnapshotCache:
+    MAX_AGE = 300  # 检测任务未运行时的兜底过期时间
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._snapshots = {}
+
+    def _fresh(self, key):
+        with self._lock:
+            snap = self._snapshots.get(key)
+        if snap and time.time() - snap['ts'] < self.MAX_AGE: return snap
+        return None
+
+    def get(self, is_admin, days=7):
+        key = (bool(is_admin), days)
+        snap = self._fresh(key)
+        if snap: return snap
+        with self._build_lock:
+            # 等锁期间可能已被其他请求生成
+            return self._fresh(key) or self._build(key)
+
+    def _build(self, key):
+        data = build_stats(*key)
+        body = app.json.dumps(data)
+        snap = {'ts': time.time(), 'data': data, 'body': body, 'etag': hashlib.sha1(body.encode()).hexdigest(), 'variants': {}}
+        with self._lock:
+            self._snapshots[key] = snap
+        return snap
+
+    def variant(self, snap, fields=STATS_ALL_FIELDS, compact=False, encoding=None):
+        # 同一快照的字段子集 / 短键布局 / 压缩结果只在首次请求时生成，随快照一起过期
+        key = (fields, compact, encoding)
+        with self._lock:
+            v = snap['variants'].get(key)
+        if v: return v
+        body = snap['body'] if fields == STATS_ALL_FIELDS and not compact else app.json.dumps(project_stats(snap['data'], fields, compact))
+        raw = body.encode()
+        etag = hashlib.sha1(raw).hexdigest()
+        if encoding and len(raw) >= 1024:
+            raw = compress_body(raw, encoding)
+            etag = f"{etag}-{encoding}"
+        else: encoding = None
+        v = {'body': raw, 'etag': etag, 'encoding': encoding}
+        with self._lock:
+            return snap['variants'].setdefault(key, v)
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshots.clear()
+
+    def refresh(self):
+        self.invalidate()
+        with self._build_lock:
+            for is_admin in (False, True): self._build((is_admin, 7))
+
+stats_cache = StatsSnapshotCache()
+
+# ===================== 实时推送 (SSE) =====================
+# 面板通过 /api/events 订阅；检测周期结束时推送与上一次相比有变化的服务器字段，状态变更在写库后立即推送
+def stats_delta(prev, cur):
+    def diff(old, new):
+        if not isinstance(old, dict) or not isinstance(new, dict): return new
+        return {k: diff(old.get(k), v) for k, v in new.items() if old.get(k) != v}
+
+    old = {s['name']: s for s in prev['servers']} if prev else {}
+    changed = [dict(diff(old.get(s['name']), s), name=s['name']) for s in cur['servers'] if old.get(s['name']) != s]
+    names = {s['name'] for s in cur['servers']}
+    removed = [n for n in old if n not in names]
+    if prev and not changed and not removed: return None
+    dates, trends = cur['trends']['dates'], cur['trends']['data']
+    return {
+        'servers': changed, 'removed': removed, 'summary': cur['summary'], 'last_updated': cur['last_updated'],
+        # 趋势只有今天这一点会随周期变化
+        'trend_today': {'date': dates[-1] if dates else None,
+                        'data': {s['name']: {k: v[-1] for k, v in trends[s['name']].items()} for s in changed if s['name'] in trends}}
+    }
+
+def sse_subscriber_limit():
+    # gunicorn gthread 下每个 SSE 连接占用 worker 的一个线程，需保留至少 1/4 (不少于 2 个) 线程处理其他请求；
+    # 超出的客户端收到 503 后由面板改为定时轮询。开发服务器 (未设置 WEB_THREADS) 每个请求一个线程，不受此限制
+    threads = os.environ.get('WEB_THREADS')
+    if not threads: return 100
+    threads = int(threads)
+    return max(1, threads - max(2, threads // 4))
+
+class EventHub:
+    KEEPALIVE = 20        # 无事件时发送注释行的间隔 (秒)，同时用于发现已断开的连接
+    QUEUE_SIZE = 50       # 单个订阅者积压上限，超过视为失联并断开，客户端会自动重连
+    MAX_SUBSCRIBERS = sse_subscriber_limit()
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subs = {}  # id -> {'admin', 'queue', 'closed'}
+        self._last = {}  # is_admin -> 上一次推送时的统计数据
+        self._stats_lock = threading.Lock()
+
+    def subscribe(self, is_admin):
+        with self._lock:
+            if len(self._subs) >= self.MAX_SUBSCRIBERS: return None
+            sub = {'admin': bool(is_admin), 'queue': queue.Queue(self.QUEUE_SIZE), 'closed': False}
+            self._subs[id(sub)] = sub
+            metrics.set('nc_sse_subscribers', len(self._subs))
+            return sub
 
-    return dates, trends
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subs.pop(id(sub), None)
+            metrics.set('nc_sse_subscribers', len(self._subs))
+
+    def publish(self, event, data, admin=None):
+        # admin 为 None 时推送给所有订阅者，否则只推送给对应视图 (管理员视图含 IP)
+        msg = f"event: {event}\ndata: {app.json.dumps(data)}\n\n"
+        with self._lock:
+            for key, sub in list(self._subs.items()):
+                if admin is not None and sub['admin'] != admin: continue
+                try: sub['queue'].put_nowait(msg)
+                except queue.Full:
+                    sub['closed'] = True
+                    del self._subs[key]
+            metrics.set('nc_sse_subscribers', len(self._subs))
+
+    def publish_stats(self):
+        # 与上一次推送的快照比较，只推送变化的部分
+        with self._stats_lock:
+            for is_admin in (False, True):
+                data = stats_cache.get(is_admin)['data']
+                delta = stats_delta(self._last.get(is_admin), data)
+                self._last[is_admin] = data
+                if delta: self.publish('stats', delta, admin=is_admin)
+
+    def stream(self, sub):
+        try:
+            yield "retry: 5000\n\n"
+            while not sub['closed']:
+                try: yield sub['queue'].get(timeout=self.KEEPALIVE)
+                except queue.Empty: yield ": ping\n\n"
+        finally:
+            self.unsubscribe(sub)
+
+event_hub = EventHub()
+
+# 检测写库后刷新快照、推送 SSE 并通知其他 worker。按服务器调度时部分周期较频繁：状态变化时立即发布，
+# 否则两次发布至少间隔 MIN_INTERVAL 秒，被推迟的数据由下一次发布或 leader 的定时检查 (flush) 带出
+class StatsPublisher:
+    MIN_INTERVAL = 120
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last = 0
+        self._pending = False
+
+    def publish(self, urgent=False):
+        with self._lock:
+            now = time.time()
+            if not urgent and now - self._last < self.MIN_INTERVAL:
+                self._pending = True
+                return False
+            self._last, self._pending = now, False
+        try:
+            stats_cache.refresh()
+            event_hub.publish_stats()
+        except Exception as e: logger.error(f"统计快照生成失败: {e}")
+        leader.cycle_done()
+        return True
+
+    def flush(self):
+        if self._pending: self.publish()
+
+stats_publisher = StatsPublisher()
 
 # ===================== 路由与任务 =====================
 @app.route('/')
@@ -251,6 +907,7 @@ def login():
     else:
         pln = cfg.get('admin_password', 'admin')
         if pwd == pln:
+            cfg = thaw(cfg)
             cfg['admin_password_hash'] = h
             if 'admin_password' in cfg: del cfg['admin_password']
             save_config_file(cfg)
@@ -281,6 +938,7 @@ def handle_config():
             old = load_config()
             if 'admin_password_hash' in old: new_c['admin_password_hash'] = old['admin_password_hash']
         save_config_file(new_c)
+        leader.sync_config()
         return jsonify({"status": "success"})
     if not session.get('logged_in'): return jsonify({})
     return jsonify(load_config())
@@ -288,145 +946,285 @@ def handle_config():
 @app.route('/api/run_now', methods=['POST'])
 def manual_run():
     if not session.get('logged_in'): return jsonify({"status": "error"}), 401
-    logger.info(f"用户触发手动刷新 (IP: {request.remote_addr})")
-    scheduler.get_job('monitor_job').modify(next_run_time=datetime.datetime.now())
+    # 可选 {"servers": [名称, ...]}，只检测指定的服务器；不传则检测全部
+    names = (request.get_json(silent=True) or {}).get('servers') or None
+    logger.info(f"用户触发手动刷新 (IP: {request.remote_addr}){': ' + ', '.join(names) if names else ''}")
+    leader.request_run(names)
     return jsonify({"status": "ok"})
 
+# 以下诊断接口的数据只存在于调度进程中；其他 worker 返回调度进程定期写入 data/leader_state.json 的内容
+@app.route('/api/notify_queue')
+def get_notify_queue():
+    if not session.get('logged_in'): return jsonify({"status": "error"}), 401
+    state = leader.shared_state()
+    return jsonify(state['notify_queue'] if state else notifier.stats())
+
+@app.route('/api/schedule')
+def get_schedule():
+    if not session.get('logged_in'): return jsonify({"status": "error"}), 401
+    state = leader.shared_state()
+    if state is None: return jsonify(poll_scheduler.stats())
+    # 按写入后经过的时间修正相对时间
+    age = time.time() - state['ts']
+    return jsonify({n: dict(h, next_in=round(h['next_in'] - age, 1), state_age=h['state_age'] + round(age)) for n, h in state['schedule'].items()})
+
+@app.route('/api/qb_sessions')
+def get_qb_sessions():
+    if not session.get('logged_in'): return jsonify({"status": "error"}), 401
+    state = leader.shared_state()
+    return jsonify({"status": "success", "data": state['qb_sessions'] if state else qb_pool.stats()})
+
+def render_metrics(config):
+    # 会话池以 base URL 为键，这里换成服务器名，避免在指标中暴露 IP
+    port = config.get('qb_config', {}).get('port', 8080)
+    pool_stats = qb_pool.stats()
+    logins = []
+    for s in config.get('servers', []):
+        st = pool_stats.get(f"http://{s['ip']}:{port}/api/v2")
+        if st: logins.append(({'server': s['name']}, st['logins']))
+    metrics.replace('nc_qb_logins_total', logins)
+    return metrics.render()
+
+@app.route('/metrics')
+def get_metrics():
+    # 配置了 metrics_token 时需要 Authorization: Bearer <token> (或已登录)
+    config = load_config()
+    token = config.get('metrics_token')
+    if token and request.headers.get('Authorization') != f"Bearer {token}" and not session.get('logged_in'):
+        return "unauthorized\n", 401
+    state = leader.shared_state()
+    body = state['metrics'] if state else render_metrics(config)
+    return app.response_class(body, content_type='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route('/api/logs')
 def get_logs():
     if not session.get('logged_in'): return jsonify({"status": "error"}), 401
+    # lines: 返回末尾 N 行；cursor: 上次返回的字节偏移，仅返回其后的新内容；level / server: 服务端过滤
+    lines = max(1, min(request.args.get('lines', 1000, type=int), LOG_TAIL_MAX_LINES))
+    cursor = request.args.get('cursor', type=int)
+    match = log_line_filter(request.args.get('level'), request.args.get('server'))
     try:
-        if os.path.exists(LOG_FILE):
-            with open(LOG_FILE, 'r', encoding='utf-8') as f:
-                content = f.read()
-                return jsonify({"status": "success", "data": content})
-        return jsonify({"status": "success", "data": "暂无日志文件"})
+        if not os.path.exists(LOG_FILE):
+            return jsonify({"status": "success", "data": "暂无日志文件", "cursor": 0})
+        with open(LOG_FILE, 'rb') as f:
+            end = os.fstat(f.fileno()).st_size
+            reset = cursor is None or cursor > end or end - cursor > LOG_READ_MAX_BYTES
+            if reset:
+                # 首次加载、日志已轮转或落后太多：直接返回末尾 N 行
+                out = tail_log_lines(f, end, lines, match)
+            else:
+                f.seek(cursor)
+                chunk = f.read(end - cursor)
+                # 只返回完整的行，未写完的一行留到下次
+                end = cursor + chunk.rfind(b'\n') + 1
+                out = [l for l in chunk[:end - cursor].split(b'\n') if l and (match is None or match(l))]
+        data = "\n".join(l.decode('utf-8', errors='replace') for l in out)
+        return gzip_response(jsonify({"status": "success", "data": data, "cursor": end, "reset": reset}))
     except Exception as e:
         logger.error(f"读取日志文件失败: {e}")
         return jsonify({"status": "error", "message": str(e)})
 
+# 每次查询都要遍历区间内的样本：未登录只允许面板提供的范围 (最长 90 天)，登录后最长一年
+HISTORY_PUBLIC_RANGE = 90 * 86400
+HISTORY_MAX_RANGE = 366 * 86400
+
+@app.route('/api/history')
+def get_history_api():
+    # ?server=名称&start=&end= (unix 时间戳，默认最近 7 天)&points= (默认 300，最多 1000)
+    name = request.args.get('server', '')
+    if name not in {s['name'] for s in load_config().get('servers', [])}:
+        return jsonify({"status": "error", "message": "unknown server"}), 404
+    end = request.args.get('end', time.time(), type=float)
+    start = request.args.get('start', end - 7 * 86400, type=float)
+    points = min(HISTORY_MAX_POINTS, max(10, request.args.get('points', HISTORY_DEFAULT_POINTS, type=int)))
+    if start >= end: return jsonify({"status": "error", "message": "start must be before end"}), 400
+    # 多留一分钟，容忍客户端计算 start 时的误差
+    if end - start > HISTORY_MAX_RANGE + 60:
+        return jsonify({"status": "error", "message": "range must not exceed 366 days"}), 400
+    if end - start > HISTORY_PUBLIC_RANGE + 60 and not session.get('logged_in'):
+        return jsonify({"status": "error", "message": "login required for ranges over 90 days"}), 401
+    return gzip_response(jsonify(get_history(db.read(), name, start, end, points)))
+
+@app.route('/api/export')
+def export_data():
+    # ?table=traffic|events&format=csv|ndjson&server=&start=&end= (unix 时间戳或 ISO 日期)，流式输出
+    if not session.get('logged_in'): return jsonify({"status": "error"}), 401
+    table, fmt = request.args.get('table', 'traffic'), request.args.get('format', 'csv')
+    if table not in EXPORT_TABLES or fmt not in EXPORT_FORMATS:
+        return jsonify({"status": "error", "message": "unsupported table or format"}), 400
+    try: start, end = parse_time(request.args.get('start')), parse_time(request.args.get('end'))
+    except ValueError: return jsonify({"status": "error", "message": "invalid start / end"}), 400
+    server = request.args.get('server') or None
+    logger.info(f"导出 {table} ({fmt}, server={server or 'all'}) (IP: {request.remote_addr})")
+    resp = app.response_class(iter_export(DB_FILE, table, fmt, server, start, end), mimetype='text/csv' if fmt == 'csv' else 'application/x-ndjson')
+    resp.headers['Content-Disposition'] = f'attachment; filename="{table}_{datetime.datetime.now():%Y%m%d_%H%M%S}.{fmt}"'
+    return resp
+
+@app.route('/api/events')
+def get_events():
+    sub = event_hub.subscribe(session.get('logged_in', False))
+    if sub is None: return jsonify({"status": "error", "message": "too many subscribers"}), 503
+    resp = app.response_class(event_hub.stream(sub), mimetype='text/event-stream')
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no'  # 反向代理 (nginx) 不缓冲
+    return resp
+
 @app.route('/api/stats_advanced')
 def get_stats_advanced():
-    cfg = load_config()
-    servers = cfg.get("servers", [])
-    conn = sqlite3.connect(DB_FILE)
+    # fields=summary,status,traffic,health,trends (默认全部)；compact=1 使用短键布局；按 Accept-Encoding 返回 br / gzip
     is_admin = session.get('logged_in', False)
-    res = []
-    summ = {'total': 0, 'high': 0, 'low': 0, 'offline': 0}
-    
-    for s in servers:
-        n = s['name']
-        u_d, d_d, u_m, d_m, c_u, c_d, u_avg, d_avg = calculate_traffic(conn, n)
-        st, dur, t_day, t_avg = calculate_health(conn, n)
-        
-        summ['total'] += 1
-        if st == 'unknown': summ['offline'] += 1
-        else: summ[st] += 1
-        
-        obj = {
-            'name': n, 'status': st,
-            'traffic': { 'qb_current_up': c_u, 'qb_current_dl': c_d, 'up_today': u_d, 'dl_today': d_d, 'up_month': u_m, 'dl_month': d_m, 'up_daily_avg': u_avg, 'dl_daily_avg': d_avg },
-            'health': { 'current_duration': dur, 'today_throttled': t_day, 'avg_daily_throttled': t_avg }
-        }
-        if is_admin: obj['ip'] = s['ip']
-        res.append(obj)
-    
-    trend_dates, trends = get_daily_trends(conn, servers)
-    conn.close()
-    return jsonify({
-        'servers': res, 
-        'summary': summ, 
-        'is_admin': is_admin, 
-        'last_updated': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-        'trends': {'dates': trend_dates, 'data': trends}
-    })
+    fields = request.args.get('fields')
+    fields = frozenset(f.strip() for f in fields.split(',') if f.strip()) if fields else STATS_ALL_FIELDS
+    if not fields or not fields <= STATS_ALL_FIELDS:
+        return jsonify({"status": "error", "message": f"fields must be a subset of: {', '.join(STATS_FIELDS)}"}), 400
+    compact = request.args.get('compact', '') in ('1', 'true')
+    days = request.args.get('days', 7, type=int)
+    # 不需要趋势时统一使用默认快照 (每个周期预先生成)
+    snap = stats_cache.get(is_admin, days if 'trends' in fields and days in TREND_WINDOWS else 7)
+    v = stats_cache.variant(snap, fields, compact, pick_encoding())
+    resp = app.response_class(v['body'], mimetype='application/json')
+    if v['encoding']: resp.headers['Content-Encoding'] = v['encoding']
+    resp.set_etag(v['etag'])
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['Vary'] = 'Cookie, Accept-Encoding'
+    return resp.make_conditional(request)
 
 # ===================== Vertex 客户端 =====================
+# 进程级复用：连接池化的 Session、内存中的 SID (仅在变化后写回配置)，
+# 下载器列表与上次成功同步时相同则跳过整个 RSS 规则同步，需要修改的规则并发提交
 class EnhancedVertexClient:
-    def __init__(self, config):
-        self.conf = config.get("vertex_config", {})
-        base_url = self.conf.get("api_url", "")
+    RULES_TTL = 3600        # 下载器列表不变时，也每隔一段时间重新核对一次规则 (防止在 Vertex 中被手动改动)
+    MAX_PARALLEL = 4
+
+    def __init__(self, config=None):
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._session = requests.Session()
+        self.conf = {}
+        self.base_url = ''
+        self.proxies = {}
+        self.sid = None
+        self._saved_sid = None
+        self._synced = None  # (同步键, 时间)
+        if config is not None: self.configure(config)
+
+    def configure(self, config):
+        conf = config.get("vertex_config", {})
+        if conf == self.conf: return
+        base_url = conf.get("api_url", "")
         if base_url and not base_url.startswith(('http://', 'https://')): base_url = 'http://' + base_url
-        self.base_url = base_url.rstrip('/')
-        self.container_name = self.conf.get("container_name", "vertex")
+        proxy = conf.get("vt_proxy")
+        with self._lock:
+            if base_url.rstrip('/') != self.base_url: self._synced = None
+            self.conf = conf
+            self.base_url = base_url.rstrip('/')
+            self.container_name = conf.get("container_name", "vertex")
+            self.proxies = {"http": proxy, "https": proxy} if proxy else {}
+            # 配置文件中的 SID 被外部修改 (或首次加载) 时以配置为准
+            if conf.get("connect_sid") != self._saved_sid: self.sid = self._saved_sid = conf.get("connect_sid")
+
     def get_new_sid(self):
         try:
             user = self.conf.get("api_user", "")
             pwd = self.conf.get("api_password", "")
             if not self.base_url or not user: return None
-            s = requests.Session()
-            try: s.get(f"{self.base_url}/login", timeout=5) 
+            self._session.cookies.clear()
+            try: self._session.get(f"{self.base_url}/login", timeout=5, proxies=self.proxies)
             except: pass
             payloads = [{"username": user, "password": pwd}, {"username": user, "password": hashlib.md5(pwd.encode()).hexdigest()}]
-            proxy = self.conf.get("vt_proxy")
-            if (proxy and proxy != ""):
-                proxies = {"http": proxy, "https": proxy}
-            else:
-                proxies = {}
             for p in payloads:
                 try:
-                    r = s.post(f"{self.base_url}/api/user/login", json=p, timeout=10, proxies=proxies)
-                    if r.status_code in [200, 302] and "connect.sid" in s.cookies:
-                        sid = s.cookies["connect.sid"]
-                        self._save_sid(sid)
+                    r = self._session.post(f"{self.base_url}/api/user/login", json=p, timeout=10, proxies=self.proxies)
+                    if r.status_code in [200, 302] and "connect.sid" in self._session.cookies:
+                        self.sid = self._session.cookies["connect.sid"]
                         logger.info("Vertex 重新登录成功，获取新 SID")
-                        return sid
+                        return self.sid
                 except: continue
             logger.warning("Vertex 登录失败")
             return None
         except Exception as e: 
             logger.error(f"Vertex 客户端初始化错误: {e}")
             return None
-    def _save_sid(self, sid):
+
+    def _relogin(self, stale_sid):
+        # 并发的修改请求同时发现 SID 失效时只登录一次
+        with self._lock:
+            if self.sid != stale_sid: return self.sid
+            return self.get_new_sid()
+
+    def flush_sid(self):
+        # 新 SID 只在变化后写回配置文件一次，而不是在登录路径上
+        if not self.sid or self.sid == self._saved_sid: return
         try:
-            full = load_config()
+            full = thaw(load_config())
             if "vertex_config" not in full: full["vertex_config"] = {}
-            full["vertex_config"]["connect_sid"] = sid
+            full["vertex_config"]["connect_sid"] = self.sid
             save_config_file(full)
+            self._saved_sid = self.sid
         except: pass
+
     def list_rss_rules(self):
-        sid = self.conf.get("connect_sid")
+        sid = self.sid
         data = self._do_list(sid)
         if data is None:
-            new_sid = self.get_new_sid()
+            new_sid = self._relogin(sid)
             if new_sid: return self._do_list(new_sid)
         return data
     def _do_list(self, sid):
         try:
-            proxy = self.conf.get("vt_proxy")
-            if (proxy and proxy != ""):
-                proxies = {"http": proxy, "https": proxy}
-            else:
-                proxies = {}
-            url = f"{self.base_url}/api/rss/list"
-            r = requests.get(url, cookies={"connect.sid": sid}, timeout=10, proxies=proxies)
+            r = self._session.get(f"{self.base_url}/api/rss/list", cookies={"connect.sid": sid or ''}, timeout=10, proxies=self.proxies)
             if r.status_code == 200:
                 res_json = r.json()
                 if res_json.get("success"): return res_json.get("data", [])
             return None
         except: return None
     def update_rss(self, rss_data):
-        sid = self.conf.get("connect_sid")
+        sid = self.sid
         if not self._do_update(rss_data, sid):
-            new_sid = self.get_new_sid()
+            new_sid = self._relogin(sid)
             if new_sid: return self._do_update(rss_data, new_sid)
             return False
         return True
     def _do_update(self, data, sid):
         try:
-            proxy = self.conf.get("vt_proxy")
-            if (proxy and proxy != ""):
-                proxies = {"http": proxy, "https": proxy}
-            else:
-                proxies = {}
-            url = f"{self.base_url}/api/rss/modify"
-            r = requests.post(url, json=data, cookies={"connect.sid": sid}, headers={"Content-Type": "application/json"}, timeout=10, proxies=proxies)
+            r = self._session.post(f"{self.base_url}/api/rss/modify", json=data, cookies={"connect.sid": sid or ''}, timeout=10, proxies=self.proxies)
             success = r.status_code == 200 and "成功" in r.text
             if not success: logger.warning(f"Vertex RSS 更新响应异常: {r.text[:100]}")
             return success
         except Exception as e: 
             logger.error(f"Vertex RSS 更新请求失败: {e}")
             return False
+
+    def sync_rules(self, rss_ids, good_clients):
+        # 返回 False 表示有规则更新失败 (调用方据此重启本机 Vertex 容器)
+        key = (self.base_url, tuple(sorted(rss_ids)), frozenset(good_clients))
+        with self._sync_lock:
+            if self._synced and self._synced[0] == key and time.time() - self._synced[1] < self.RULES_TTL: return True
+            all_rules = self.list_rss_rules()
+            if not all_rules:
+                logger.warning("无法获取 RSS 规则列表")
+                return True
+            target_clients = set(good_clients)
+            changed = []
+            for rule in all_rules:
+                rule_id = str(rule.get('id', ''))
+                if rule_id in rss_ids:
+                    current_clients = set(rule.get('clientArr', []))
+                    if current_clients != target_clients:
+                        logger.info(f"RSS [{rule.get('alias', rule_id)}] 需更新: {len(current_clients)} -> {len(target_clients)}")
+                        rule['clientArr'] = list(target_clients)
+                        rule['enable'] = bool(target_clients)
+                        changed.append(rule)
+            ok = True
+            if changed:
+                with ThreadPoolExecutor(max_workers=min(self.MAX_PARALLEL, len(changed)), thread_name_prefix='vertex') as pool:
+                    for rule, success in zip(changed, pool.map(self.update_rss, changed)):
+                        if success: logger.info(f"RSS API 更新成功 [{rule.get('alias', rule.get('id'))}]")
+                        else: logger.error(f"RSS API 更新失败 [{rule.get('alias', rule.get('id'))}]")
+                        ok = ok and success
+            self._synced = (key, time.time()) if ok else None
+            self.flush_sid()
+            return ok
     def restart_container(self):
         if "localhost" not in self.base_url and "127.0.0.1" not in self.base_url: return False
         try:
@@ -437,97 +1235,491 @@ class EnhancedVertexClient:
             logger.error(f"Vertex 容器重启失败: {e}")
             return False
 
-def send_notifications(config):
-    notify_mode = config.get("notify_mode", "telegram") 
+vertex_client = EnhancedVertexClient()
+
+def build_notification(config):
+    # 生成各渠道的状态简报文本 (发送时的最新状态，突发的多次状态变更合并为一份)
+    servers = config.get("servers", [])
+    conn = db.read()
     
-    try:
-        servers = config.get("servers", [])
-        conn = sqlite3.connect(DB_FILE)
-        
-        tg_lines = [f"📊 <b>服务器状态简报</b> ({datetime.datetime.now().strftime('%H:%M')})", ""]
-        wx_lines = [f"### 📊 服务器状态简报 ({datetime.datetime.now().strftime('%H:%M')})"]
-        plain_lines = [f"📊 服务器状态简报 ({datetime.datetime.now().strftime('%H:%M')})", ""]
+    tg_lines = [f"📊 <b>服务器状态简报</b> ({datetime.datetime.now().strftime('%H:%M')})", ""]
+    wx_lines = [f"### 📊 服务器状态简报 ({datetime.datetime.now().strftime('%H:%M')})"]
+    plain_lines = [f"📊 服务器状态简报 ({datetime.datetime.now().strftime('%H:%M')})", ""]
+    
+    for s in servers:
+        name = s['name']
+        state, dur, t_day_throttled, _ = calculate_health(conn, name)
+        now = datetime.datetime.now()
+        start_of_day = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        total_seconds_today = (now - start_of_day).total_seconds()
+        t_day_high = max(0, total_seconds_today - t_day_throttled)
         
-        for s in servers:
-            name = s['name']
-            state, dur, t_day_throttled, _ = calculate_health(conn, name)
-            now = datetime.datetime.now()
-            start_of_day = now.replace(hour=0, minute=0, second=0, microsecond=0)
-            total_seconds_today = (now - start_of_day).total_seconds()
-            t_day_high = max(0, total_seconds_today - t_day_throttled)
-            
-            status_icon = "✅ 高速" if state == 'high' else "⚠️ 限速"
-            
-            tg_lines.append(f"<b>{name}</b>")
-            tg_lines.append(f"当前: {status_icon} (持续 {format_duration(dur)})")
-            tg_lines.append(f"今日: 高速 {format_duration(t_day_high)} | 限速 {format_duration(t_day_throttled)}\n")
-            
-            wx_lines.append(f"**{name}**")
-            wx_lines.append(f"> 当前: {status_icon} (持续 {format_duration(dur)})")
-            wx_lines.append(f"> 今日: 高速 {format_duration(t_day_high)} | 限速 {format_duration(t_day_throttled)}\n")
-            
-            plain_lines.append(f"【{name}】")
-            plain_lines.append(f"当前: {status_icon} (持续 {format_duration(dur)})")
-            plain_lines.append(f"今日: 高速 {format_duration(t_day_high)} | 限速 {format_duration(t_day_throttled)}\n")
-            
-        conn.close()
+        status_icon = "✅ 高速" if state == 'high' else "⚠️ 限速"
         
-        tg_text = "\n".join(tg_lines)
-        wx_text = "\n".join(wx_lines)
-        plain_text = "\n".join(plain_lines)
+        tg_lines.append(f"<b>{name}</b>")
+        tg_lines.append(f"当前: {status_icon} (持续 {format_duration(dur)})")
+        tg_lines.append(f"今日: 高速 {format_duration(t_day_high)} | 限速 {format_duration(t_day_throttled)}\n")
         
-        if notify_mode in ['telegram', 'all']:
-            tg_conf = config.get("telegram_config", {})
-            token = tg_conf.get("bot_token")
-            chat_id = tg_conf.get("chat_id")
-            tg_proxy = tg_conf.get("tg_proxy")
-            if (tg_proxy and tg_proxy != ""):
-                proxies = {"http": tg_proxy, "https": tg_proxy}
-            else:
-                proxies = {}
-            if token and chat_id:
-                try:
-                    requests.post(f"https://api.telegram.org/bot{token}/sendMessage", json={"chat_id": chat_id, "text": tg_text, "parse_mode": "HTML"}, timeout=10, proxies=proxies)
-                    logger.info("Telegram 通知发送成功")
-                except Exception as e: logger.error(f"Telegram 发送失败: {e}")
+        wx_lines.append(f"**{name}**")
+        wx_lines.append(f"> 当前: {status_icon} (持续 {format_duration(dur)})")
+        wx_lines.append(f"> 今日: 高速 {format_duration(t_day_high)} | 限速 {format_duration(t_day_throttled)}\n")
         
-        if notify_mode in ['wechat', 'all']:
-            wx_key = config.get("wechat_config", {}).get("key")
-            if wx_key:
-                try:
-                    url = f"https://qyapi.weixin.qq.com/cgi-bin/webhook/send?key={wx_key}"
-                    requests.post(url, json={"msgtype": "markdown", "markdown": {"content": wx_text}}, timeout=10)
-                    logger.info("企业微信(Webhook)通知发送成功")
-                except Exception as e: logger.error(f"企业微信(Webhook)发送失败: {e}")
+        plain_lines.append(f"【{name}】")
+        plain_lines.append(f"当前: {status_icon} (持续 {format_duration(dur)})")
+        plain_lines.append(f"今日: 高速 {format_duration(t_day_high)} | 限速 {format_duration(t_day_throttled)}\n")
+    
+    return {'telegram': "\n".join(tg_lines), 'wechat': "\n".join(wx_lines), 'wechat_app': "\n".join(plain_lines)}
+
+# ===================== 通知分发 =====================
+# 检测周期只登记「需要发送简报」，由后台线程在合并窗口结束后生成简报并写入 notify_outbox；
+# 各渠道并发投递，失败按指数退避重试，队列持久化在 SQLite 中，服务商暂时故障或进程重启都不会丢失通知
+class NotifyError(Exception):
+    pass
+
+class Notifier:
+    COALESCE = 60               # 状态变更后等待合并的时间 (秒)
+    RETRY_BASE = 30
+    RETRY_MAX = 3600
+    MAX_ATTEMPTS = 12
+    TOKEN_MARGIN = 300          # access_token 到期前提前刷新
+    CHANNELS = ('telegram', 'wechat', 'wechat_app')
 
-        if notify_mode in ['wechat_app', 'all']:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._digest_due = None
+        self._tokens = {}  # (corpid, secret) -> (access_token, 过期时间)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True, name='notifier')
+                self._thread.start()
+
+    def notify(self):
+        # 合并窗口内的多次调用只生成一份简报，且不推迟已登记的发送时间
+        with self._lock:
+            if self._digest_due is None: self._digest_due = time.time() + self.COALESCE
+        self.start()
+        self._wake.set()
+
+    @staticmethod
+    def channels(config):
+        mode = config.get("notify_mode", "telegram")
+        tg = config.get("telegram_config", {})
+        wca = config.get("wechat_app_config", {})
+        enabled = {
+            'telegram': bool(tg.get("bot_token") and tg.get("chat_id")),
+            'wechat': bool(config.get("wechat_config", {}).get("key")),
+            'wechat_app': bool(wca.get("corpid") and wca.get("secret") and wca.get("agentid")),
+        }
+        return [ch for ch in Notifier.CHANNELS if enabled[ch] and mode in (ch, 'all')]
+
+    def _send_telegram(self, text, config):
+        tg_conf = config.get("telegram_config", {})
+        tg_proxy = tg_conf.get("tg_proxy")
+        proxies = {"http": tg_proxy, "https": tg_proxy} if tg_proxy else {}
+        r = requests.post(f"https://api.telegram.org/bot{tg_conf.get('bot_token')}/sendMessage",
+                          json={"chat_id": tg_conf.get("chat_id"), "text": text, "parse_mode": "HTML"}, timeout=10, proxies=proxies)
+        if r.status_code != 200: raise NotifyError(f"HTTP {r.status_code} {r.text[:100]}")
+
+    def _send_wechat(self, text, config):
+        url = f"https://qyapi.weixin.qq.com/cgi-bin/webhook/send?key={config.get('wechat_config', {}).get('key')}"
+        res = requests.post(url, json={"msgtype": "markdown", "markdown": {"content": text}}, timeout=10).json()
+        if res.get("errcode") != 0: raise NotifyError(f"{res}")
+
+    def _wechat_token(self, corpid, secret, refresh=False):
+        key = (corpid, secret)
+        with self._lock:
+            token, expires = self._tokens.get(key, (None, 0))
+        if token and not refresh and time.time() < expires - self.TOKEN_MARGIN: return token
+        r = requests.get(f"https://qyapi.weixin.qq.com/cgi-bin/gettoken?corpid={corpid}&corpsecret={secret}", timeout=10)
+        token_data = r.json()
+        if token_data.get("errcode") != 0: raise NotifyError(f"企业微信应用Token获取失败: {token_data}")
+        with self._lock:
+            self._tokens[key] = (token_data["access_token"], time.time() + int(token_data.get("expires_in", 7200)))
+        return token_data["access_token"]
+
+    def _send_wechat_app(self, text, config):
+        wca = config.get("wechat_app_config", {})
+        payload = {"touser": "@all", "msgtype": "text", "agentid": wca.get("agentid"), "text": {"content": text}}
+        for refresh in (False, True):
+            token = self._wechat_token(wca.get("corpid"), wca.get("secret"), refresh=refresh)
+            res = requests.post(f"https://qyapi.weixin.qq.com/cgi-bin/message/send?access_token={token}", json=payload, timeout=10).json()
+            # 40014 / 42001: token 无效或已过期 (例如被其他程序刷新)，强制刷新后重试一次
+            if res.get("errcode") in (40014, 42001) and not refresh: continue
+            if res.get("errcode") != 0: raise NotifyError(f"{res}")
+            return
+
+    def _deliver(self, row, config):
+        row_id, channel, payload, attempts = row
+        try:
+            if channel not in self.channels(config): return row_id, 'dropped', None
+            getattr(self, f"_send_{channel}")(json.loads(payload)['text'], config)
+            return row_id, 'sent', None
+        except Exception as e:
+            return row_id, 'failed', str(e)[:200]
+
+    def _next_wake(self):
+        now = time.time()
+        waits = [300]
+        with self._lock:
+            if self._digest_due is not None: waits.append(self._digest_due - now)
+        row = db.read().execute("SELECT MIN(next_try) FROM notify_outbox").fetchone()
+        if row[0] is not None: waits.append(row[0] - now)
+        return max(0, min(waits))
+
+    def _tick(self):
+        config = load_config()
+        now = time.time()
+        with self._lock:
+            digest = self._digest_due is not None and self._digest_due <= now
+            if digest: self._digest_due = None
+        if digest:
+            messages = build_notification(config)
+            with db.write() as conn:
+                conn.executemany("INSERT INTO notify_outbox (channel, payload, created, next_try) VALUES (?, ?, ?, ?)",
+                                 [(ch, json.dumps({'text': messages[ch]}, ensure_ascii=False), now, now) for ch in self.channels(config)])
+
+        rows = db.read().execute("SELECT id, channel, payload, attempts FROM notify_outbox WHERE next_try <= ? ORDER BY id LIMIT 50", (now,)).fetchall()
+        if not rows: return
+        with ThreadPoolExecutor(max_workers=len(self.CHANNELS), thread_name_prefix='notify') as pool:
+            outcomes = list(pool.map(lambda r: self._deliver(r, config), rows))
+
+        attempts = {r[0]: (r[1], r[3] + 1) for r in rows}
+        with db.write() as conn:
+            for row_id, result, error in outcomes:
+                channel, n = attempts[row_id]
+                metrics.inc('nc_notify_total', channel=channel, result=result)
+                if result == 'sent':
+                    logger.info(f"{channel} 通知发送成功")
+                elif result == 'failed' and n < self.MAX_ATTEMPTS:
+                    delay = min(self.RETRY_MAX, self.RETRY_BASE * 2 ** (n - 1))
+                    logger.warning(f"{channel} 通知发送失败 (第 {n} 次)，{delay}s 后重试: {error}")
+                    conn.execute("UPDATE notify_outbox SET attempts=?, next_try=?, last_error=? WHERE id=?", (n, time.time() + delay, error, row_id))
+                    continue
+                elif result == 'failed':
+                    logger.error(f"{channel} 通知多次发送失败，已放弃: {error}")
+                conn.execute("DELETE FROM notify_outbox WHERE id=?", (row_id,))
+
+    def _run(self):
+        while True:
+            try: timeout = self._next_wake()
+            except Exception: timeout = self.RETRY_BASE
+            self._wake.wait(timeout)
+            self._wake.clear()
+            try: self._tick()
+            except Exception as e: logger.error(f"通知队列处理失败: {e}")
+
+    def stats(self):
+        rows = db.read().execute("SELECT channel, COUNT(*), MAX(attempts), MIN(next_try) FROM notify_outbox GROUP BY channel").fetchall()
+        with self._lock: due = self._digest_due
+        return {'digest_due': due, 'outbox': {ch: {'pending': n, 'max_attempts': a, 'next_try': t} for ch, n, a, t in rows}}
+
+notifier = Notifier()
+
+# ===================== Netcup SCP (SOAP) 客户端 =====================
+# 进程级复用 zeep Client (WSDL 缓存在 data/ 下)，并按账号缓存 vServer 名称 -> IP 的映射，
+# 每周期只对已知属于监控列表的 vServer 并发查询 getVServerInformation
+class NetcupSoapClient:
+    VSERVER_TTL = 24 * 3600      # vServer 列表与 IP 映射的常规刷新间隔
+    MISS_RETRY = 30 * 60         # 有监控 IP 未匹配到 vServer 时的提前刷新间隔
+    WSDL_CACHE_TTL = 7 * 86400
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._client = None
+        self._wsdl_url = None
+        self._vservers = {}  # customer_number -> {'ts': 刷新时间, 'ips': {vservername: ip}, 'retry': 上次查询失败的 vservername}
+
+    def get_client(self, wsdl_url):
+        with self._lock:
+            if self._client is None or self._wsdl_url != wsdl_url:
+                # zeep / lxml 导入较慢，只在配置了 SOAP 账号、第一次查询时加载
+                from zeep import Client
+                from zeep.cache import SqliteCache
+                from zeep.transports import Transport
+                transport = Transport(cache=SqliteCache(path=WSDL_CACHE_FILE, timeout=self.WSDL_CACHE_TTL), timeout=15, operation_timeout=30)
+                self._client = Client(wsdl_url, transport=transport)
+                self._wsdl_url = wsdl_url
+                logger.info("SOAP 客户端已初始化")
+            return self._client
+
+    def _is_stale(self, key, now, has_missing):
+        cached = self._vservers.get(key)
+        if not cached: return True
+        age = now - cached['ts']
+        return age > self.VSERVER_TTL or (has_missing and age > self.MISS_RETRY)
+
+    def _list_vservers(self, client, acc):
+        try:
+            return list(client.service.getVServers(loginName=acc['customer_number'], password=acc['password']) or [])
+        except Exception as e:
+            logger.error(f"SOAP Account Error ({acc.get('customer_number')}): {e}")
+            return None
+
+    def _query(self, client, acc, vn):
+        try:
+            info = client.service.getVServerInformation(loginName=acc['customer_number'], password=acc['password'], vservername=vn)
+            ip = info.ips[0] if info.ips else None
+            return ip, info.serverInterfaces[0].trafficThrottled
+        except Exception as e:
+            logger.error(f"SOAP vServer Error ({acc.get('customer_number')}/{vn}): {e}")
+            return None
+
+    def fetch_throttle_status(self, soap, targets, max_workers=8):
+        client = self.get_client(soap.get("wsdl_url") or DEFAULT_WSDL_URL)
+        accounts = [acc for acc in soap.get("accounts", []) if acc.get('customer_number')]
+        targets = set(targets)
+        now = time.time()
+        with self._lock:
+            known = {ip for m in self._vservers.values() for ip in m['ips'].values()}
+            stale = [acc for acc in accounts if self._is_stale(str(acc['customer_number']), now, bool(targets - known))]
+
+        status = {}
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='soap') as pool:
+            listed = {str(acc['customer_number']): names for acc, names in zip(stale, pool.map(lambda a: self._list_vservers(client, a), stale)) if names is not None}
+
+            jobs = []
+            with self._lock:
+                for acc in accounts:
+                    key = str(acc['customer_number'])
+                    if key in listed:
+                        # 刷新中的账号需要查询全部 vServer 才能得知 IP
+                        jobs += [(acc, vn) for vn in listed[key]]
+                    elif key in self._vservers:
+                        m = self._vservers[key]
+                        jobs += [(acc, vn) for vn in {vn for vn, ip in m['ips'].items() if ip in targets} | m['retry']]
+
+            results = list(pool.map(lambda j: self._query(client, *j), jobs))
+
+        with self._lock:
+            for key, names in listed.items():
+                # 刷新时查询失败的 vServer 沿用旧映射，不必等到下次刷新
+                old = self._vservers.get(key, {}).get('ips', {})
+                self._vservers[key] = {'ts': now, 'ips': {vn: old[vn] for vn in names if vn in old}, 'retry': set()}
+            for (acc, vn), res in zip(jobs, results):
+                m = self._vservers.get(str(acc['customer_number']))
+                if res is None:
+                    # 下一周期重试 (IP 未知的 vServer 也会被查询)
+                    if m is not None: m['retry'].add(vn)
+                    continue
+                ip, throttled = res
+                if m is not None:
+                    m['retry'].discard(vn)
+                    if ip: m['ips'][vn] = ip
+                if ip in targets: status[ip] = throttled
+        if listed: logger.info(f"SOAP vServer 映射已刷新 ({len(listed)} 个账号)")
+        return status
+
+soap_client = NetcupSoapClient()
+
+# ===================== qBittorrent 会话池 =====================
+# 按主机复用已登录的 Session (SID Cookie + keep-alive 连接)，仅在 403 / 会话过期时重新登录
+class QBSessionPool:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def _get_host(self, base, user, password):
+        with self._lock:
+            h = self._hosts.get(base)
+            if h is None or h['cred'] != (user, password):
+                if h: h['session'].close()
+                h = {'session': requests.Session(), 'cred': (user, password), 'lock': threading.Lock(),
+                     'authed': False, 'logins': 0, 'reuses': 0, 'failures': 0, 'last_login': None}
+                self._hosts[base] = h
+            return h
+
+    def _login(self, h, base, timeout):
+        user, password = h['cred']
+        h['logins'] += 1
+        h['last_login'] = time.time()
+        r = h['session'].post(f"{base}/auth/login", data={"username": user, "password": password}, timeout=timeout)
+        h['authed'] = r.status_code == 200 and r.text.strip() != 'Fails.'
+        if not h['authed']: logger.warning(f"QB 登录失败 ({base}): HTTP {r.status_code} {r.text[:50]}")
+        return h['authed']
+
+    def request(self, base, user, password, endpoint, data=None, login_timeout=5, timeout=15):
+        h = self._get_host(base, user, password)
+        with h['lock']:
             try:
-                wca = config.get("wechat_app_config", {})
-                corpid = wca.get("corpid")
-                secret = wca.get("secret")
-                agentid = wca.get("agentid")
-                if corpid and secret and agentid:
-                    token_url = f"https://qyapi.weixin.qq.com/cgi-bin/gettoken?corpid={corpid}&corpsecret={secret}"
-                    r = requests.get(token_url, timeout=10)
-                    token_data = r.json()
-                    if token_data.get("errcode") == 0:
-                        access_token = token_data.get("access_token")
-                        send_url = f"https://qyapi.weixin.qq.com/cgi-bin/message/send?access_token={access_token}"
-                        payload = {"touser": "@all", "msgtype": "text", "agentid": agentid, "text": {"content": plain_text}}
-                        requests.post(send_url, json=payload, timeout=10)
-                        logger.info("企业微信(应用)通知发送成功")
-                    else:
-                        logger.error(f"企业微信应用Token获取失败: {token_data}")
-            except Exception as e: logger.error(f"企业微信(应用)发送失败: {e}")
-        
-    except Exception as e: logger.error(f"构建通知时出错: {e}")
+                reused = h['authed']
+                if reused: h['reuses'] += 1
+                else: self._login(h, base, login_timeout)
+                url = f"{base}{endpoint}"
+                res = h['session'].post(url, data=data, timeout=timeout) if data else h['session'].get(url, timeout=timeout)
+                if res.status_code == 403 and reused:
+                    # SID 过期或 qB 重启：重新登录后重试一次
+                    logger.info(f"QB 会话失效，重新登录 ({base})")
+                    if self._login(h, base, login_timeout):
+                        res = h['session'].post(url, data=data, timeout=timeout) if data else h['session'].get(url, timeout=timeout)
+                if res.status_code == 403: h['authed'] = False
+                return res
+            except Exception:
+                h['failures'] += 1
+                raise
+
+    def stats(self):
+        with self._lock:
+            return {base: {k: h[k] for k in ('authed', 'logins', 'reuses', 'failures', 'last_login')} for base, h in self._hosts.items()}
+
+qb_pool = QBSessionPool()
+
+# ===================== qBittorrent 种子索引 =====================
+# 每台主机一份精简的种子索引 (hash -> 分类 / 进度 / 状态 / 上传限速)，通过 /sync/maindata 的 rid
+# 游标只合并增量；传输量与解析开销与变化量成正比，而非种子总数
+class QBTorrentIndex:
+    FIELDS = ('category', 'progress', 'state', 'up_limit')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hosts = {}  # host -> {'rid': int, 'torrents': {hash: {field: value}}}
+
+    def rid(self, host):
+        with self._lock:
+            h = self._hosts.get(host)
+            return h['rid'] if h else 0
+
+    def reset(self, host):
+        with self._lock:
+            self._hosts.pop(host, None)
+
+    def apply(self, host, data):
+        with self._lock:
+            h = self._hosts.get(host)
+            if h is None or data.get('full_update'):
+                h = self._hosts[host] = {'rid': 0, 'torrents': {}}
+            torrents = h['torrents']
+            for t_hash, fields in (data.get('torrents') or {}).items():
+                entry = torrents.get(t_hash)
+                if entry is None: entry = torrents[t_hash] = dict.fromkeys(self.FIELDS)
+                for k in self.FIELDS:
+                    if k in fields: entry[k] = fields[k]
+            for t_hash in data.get('torrents_removed') or ():
+                torrents.pop(t_hash, None)
+            h['rid'] = data.get('rid', 0)
+            return torrents
+
+    def replace(self, host, torrent_list):
+        with self._lock:
+            torrents = {t['hash']: {k: t.get(k) for k in self.FIELDS} for t in torrent_list}
+            self._hosts[host] = {'rid': 0, 'torrents': torrents}
+            return torrents
+
+    def stats(self):
+        with self._lock:
+            return {host: {'rid': h['rid'], 'torrents': len(h['torrents'])} for host, h in self._hosts.items()}
+
+torrent_index = QBTorrentIndex()
+
+# ===================== 检测调度 =====================
+# 每台服务器独立计算下次检测时间：限速中或刚发生状态变化的机器缩短间隔 (更快发现解除限速)，
+# 长时间稳定的机器放宽间隔，并加随机抖动错开请求；同一台机器的检测不会重叠
+class PollScheduler:
+    TICK = 15           # 调度器检查到期服务器的间隔 (秒)
+    RECENT = 15 * 60    # 状态变化后保持最短间隔的时长
+    BATCH = 0.2         # 有服务器到期时，距到期不足 BATCH x 间隔的服务器提前并入本轮，避免抖动把周期拆得过碎
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hosts = {}  # name -> {'due', 'interval', 'running', 'state', 'since', 'changed', 'result'}
+        self._rnd = random.Random()
+
+    @staticmethod
+    def intervals(config):
+        mon = config.get("monitor_config", {})
+        base = max(30, int(mon.get("interval", 300)))
+        return {
+            'base': base,
+            'min': min(base, max(15, int(mon.get("min_interval", 60)))),
+            'max': max(base, int(mon.get("max_interval", 900))),
+            'stable_after': int(mon.get("stable_after", 3600)),
+            'jitter': min(0.5, max(0.0, float(mon.get("jitter", 0.1)))),
+        }
+
+    def claim(self, servers, only=None, due_only=False):
+        # 选出本轮要检测的服务器并标记为运行中；正在检测的机器跳过
+        now = time.time()
+        picked, busy = [], []
+        with self._lock:
+            names = {s['name'] for s in servers}
+            for n in [n for n in self._hosts if n not in names]: del self._hosts[n]
+            for s in servers:
+                self._hosts.setdefault(s['name'], {'due': now, 'interval': 0, 'running': False, 'state': None, 'since': now, 'changed': False, 'result': None})
+            # 有服务器到期时，把即将到期的服务器一并纳入本轮
+            batch = any(h['due'] <= now and not h['running'] for h in self._hosts.values())
+            for s in servers:
+                h = self._hosts[s['name']]
+                if only is not None and s['name'] not in only: continue
+                if due_only and (not batch or h['due'] > now + h['interval'] * self.BATCH): continue
+                if h['running']:
+                    busy.append(s['name'])
+                    continue
+                h['running'] = True
+                picked.append(s)
+        if busy and not due_only: logger.info(f"以下服务器正在检测中，本次跳过: {', '.join(busy)}")
+        return picked
+
+    def release(self, name, result, config):
+        # result 为 None 表示本次没有拿到结果 (异常)，按常规间隔重试
+        now = time.time()
+        iv = self.intervals(config)
+        with self._lock:
+            h = self._hosts.get(name)
+            if h is None: return
+            h['running'] = False
+            if result is not None:
+                if h['state'] != result['state']:
+                    # since: 当前状态首次观察到的时间；changed: 是否由状态变化而来 (而非启动后首次观察)
+                    h['since'], h['changed'] = now, h['state'] is not None
+                h['state'], h['result'] = result['state'], result
+            age = now - h['since'] if h['state'] else 0
+            if h['state'] == 'low' or (h['changed'] and age < self.RECENT): interval = iv['min']
+            elif h['state'] and age >= iv['stable_after']: interval = iv['max']
+            else: interval = iv['base']
+            h['interval'] = interval
+            h['due'] = now + interval * (1 + self._rnd.uniform(-iv['jitter'], iv['jitter']))
+
+    def results(self):
+        with self._lock:
+            return {n: h['result'] for n, h in self._hosts.items() if h['result'] is not None}
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            return {n: {'state': h['state'], 'running': h['running'], 'next_in': round(h['due'] - now, 1),
+                        'state_age': round(now - h['since'])} for n, h in self._hosts.items()}
+
+poll_scheduler = PollScheduler()
 
 # ===================== 主监控循环 =====================
-def run_monitor_task():
-    logger.info(">>> 开始周期性检测...")
+def finish_late(future, name, config):
+    # 超时后才结束的检测：样本已被本周期丢弃 (原始限速在修改 qB 前已单独提交)，此时才释放该机器
+    poll_scheduler.release(name, None, config)
+
+def run_monitor_task(only=None, due_only=False):
+    # only: 只检测指定名称的服务器；due_only: 只检测已到期的服务器 (调度器定时调用)
     config = load_config()
     if not config: return
-    SERVERS = config.get("servers", [])
+    servers = poll_scheduler.claim(config.get("servers", []), only=only, due_only=due_only)
+    if not servers: return
+    logger.info(f">>> 开始检测 ({len(servers)}/{len(config.get('servers', []))} 台)...")
+    pending = {s['name'] for s in servers}
+    try: monitor_cycle(config, servers, pending)
+    finally:
+        for name in pending: poll_scheduler.release(name, None, config)
+
+def monitor_cycle(config, SERVERS, pending):
+    SERVER_NAMES = {s['ip']: s['name'] for s in SERVERS}
+
+    cycle_start = phase_start = time.perf_counter()
+    def mark(phase):
+        nonlocal phase_start
+        now = time.perf_counter()
+        metrics.observe('nc_monitor_phase_seconds', now - phase_start, phase=phase)
+        phase_start = now
     
     KEEP_CATS = config.get("keep_categories", [])
     HR_CONFIG = config.get("hr_config", {})
@@ -536,198 +1728,392 @@ def run_monitor_task():
     HR_LIMIT_BYTES = HR_LIMIT_KB * 1024
     
     QB_CONF = config.get("qb_config", {})
-    vertex = EnhancedVertexClient(config)
     
-    def qb_req(ip, endpoint, data=None):
+    MON_CONF = config.get("monitor_config", {})
+    MAX_WORKERS = max(1, int(MON_CONF.get("max_workers", 8)))
+    SERVER_TIMEOUT = max(10, int(MON_CONF.get("server_timeout", 120)))
+    
+    def qb_req(ip, endpoint, data=None, deadline=None):
         base = f"http://{ip}:{QB_CONF.get('port', 8080)}/api/v2"
+        login_timeout, req_timeout = 5, 15
+        if deadline:
+            # 单机时限：剩余时间不足则直接放弃，避免一台慢机拖住整个周期
+            remaining = deadline - time.time()
+            if remaining <= 1:
+                logger.warning(f"QB 请求超出单机时限，已跳过 ({ip}{endpoint})")
+                return None
+            login_timeout, req_timeout = min(login_timeout, remaining), min(req_timeout, remaining)
+        server = SERVER_NAMES.get(ip, ip)
+        start = time.perf_counter()
         try:
-            with requests.Session() as s:
-                s.post(f"{base}/auth/login", data={"username": QB_CONF.get("user"), "password": QB_CONF.get("password")}, timeout=5)
-                url = f"{base}{endpoint}"
-                res = s.post(url, data=data, timeout=15) if data else s.get(url, timeout=15)
-                return res
+            res = qb_pool.request(base, QB_CONF.get("user"), QB_CONF.get("password"), endpoint, data=data, login_timeout=login_timeout, timeout=req_timeout)
+            if res.status_code >= 400: metrics.inc('nc_qb_request_errors_total', server=server, kind='http')
+            return res
         except Exception as e: 
+            metrics.inc('nc_qb_request_errors_total', server=server, kind='connect')
             logger.error(f"QB 连接失败 ({ip}): {e}")
             return None
+        finally:
+            metrics.observe('nc_qb_request_seconds', time.perf_counter() - start, server=server)
         
-    def qb_smart_action(ip, action, hashes):
+    def qb_smart_action(ip, action, hashes, deadline=None):
         # 兼容性修复：对于 start 动作，优先尝试 resume，因为这是 v2 API 标准
         if action == 'start':
             action = 'resume'
             
-        r = qb_req(ip, f"/torrents/{action}", data={"hashes": hashes})
+        r = qb_req(ip, f"/torrents/{action}", data={"hashes": hashes}, deadline=deadline)
         if not r or r.status_code not in [200, 204]:
             fallback = {'stop': 'pause', 'resume': 'start'}
             if action in fallback: 
                 logger.warning(f"QB 动作 {action} 失败，尝试 fallback: {fallback[action]}")
-                qb_req(ip, f"/torrents/{fallback[action]}", data={"hashes": hashes})
+                qb_req(ip, f"/torrents/{fallback[action]}", data={"hashes": hashes}, deadline=deadline)
+            
+    def qb_sync_torrents(ip, deadline):
+        # /sync/maindata 增量同步：只传输自上次 rid 以来变化的种子
+        key = f"{ip}:{QB_CONF.get('port', 8080)}"
+        r = qb_req(ip, f"/sync/maindata?rid={torrent_index.rid(key)}", deadline=deadline)
+        if r is not None and r.status_code == 200:
+            try: return torrent_index.apply(key, r.json())
+            except ValueError as e: logger.error(f"QB maindata 解析失败 ({ip}): {e}")
+        elif r is not None and r.status_code == 404:
+            # 不支持 sync 接口的旧版本：退回全量 /torrents/info
+            tr = qb_req(ip, "/torrents/info", deadline=deadline)
+            if tr and tr.status_code == 200: return torrent_index.replace(key, tr.json())
+        torrent_index.reset(key)
+        return {}
             
     vps_status = {}
     soap = config.get("soap_config", {})
     
     if soap:
         try:
-            wsdl_url = soap.get("wsdl_url")
-            if not wsdl_url: wsdl_url = "https://www.servercontrolpanel.de/WSEndUser?wsdl"
-            client = Client(wsdl_url)
-            targets = [s['ip'] for s in SERVERS]
-            for acc in soap.get("accounts", []):
-                try:
-                    auth = {'loginName': acc['customer_number'], 'password': acc['password']}
-                    vnames = client.service.getVServers(**auth)
-                    for vn in vnames:
-                        info = client.service.getVServerInformation(**auth, vservername=vn)
-                        if info.ips and info.ips[0] in targets: 
-                            vps_status[info.ips[0]] = info.serverInterfaces[0].trafficThrottled
-                except Exception as e:
-                    logger.error(f"SOAP Account Error ({acc.get('customer_number')}): {e}")
+            vps_status = soap_client.fetch_throttle_status(soap, [s['ip'] for s in SERVERS], max_workers=MAX_WORKERS)
         except Exception as e: 
             logger.error(f"SOAP Client Init Error: {e}")
+    mark('soap')
             
-    good_clients = []
-    send_notity = False
-    for s in SERVERS:
+    def process_server(s):
         name, ip = s['name'], s['ip']
         is_unmanaged = s.get('unmanaged', False)
-        up, dl = 0, 0
-        r = qb_req(ip, "/transfer/info")
-        if r and r.status_code == 200:
-            d = r.json()
-            up, dl = d.get('up_info_data', 0), d.get('dl_info_data', 0)
-        else: 
-            up = None
-            dl = None
         is_throttled = vps_status.get(ip, False)
         state = 'low' if is_throttled else 'high'
-
-        state_change = log_to_db(name, state, up, dl)
-        if not send_notity and state_change:
-            send_notity = True
+        deadline = time.time() + SERVER_TIMEOUT
+        step_start = time.perf_counter()
+        result = {'name': name, 'state': state, 'up': None, 'dl': None, 'good_client': None, 'ts': None}
+        r = qb_req(ip, "/transfer/info", deadline=deadline)
+        result['ts'] = time.time()
+        if r and r.status_code == 200:
+            d = r.json()
+            result['up'], result['dl'] = d.get('up_info_data', 0), d.get('dl_info_data', 0)
 
         if not is_unmanaged and not is_throttled:
-            if s.get('client_id'): good_clients.append(s['client_id'])
+            if s.get('client_id'): result['good_client'] = s['client_id']
         if not is_unmanaged:
-            torrents = []
-            tr = qb_req(ip, "/torrents/info")
-            if tr and tr.status_code == 200: torrents = tr.json()
+            torrents = qb_sync_torrents(ip, deadline)
+            metrics.observe('nc_monitor_server_phase_seconds', time.perf_counter() - step_start, server=name, phase='qb')
+            step_start = time.perf_counter()
             
-            restore_file = os.path.join(DATA_DIR, f'restore_{ip}.json')
+            conn = db.read()
 
             if is_throttled:
-                restore_data = {}
-                if os.path.exists(restore_file):
-                    try:
-                        with open(restore_file, 'r', encoding='utf-8') as f:
-                            restore_data = json.load(f)
-                    except: pass
-                
-                data_changed = False
+                known = {h for (h,) in conn.execute("SELECT hash FROM torrent_restore WHERE server_name=?", (name,))}
+                new_limits = {}
                 
                 hr_hashes_seeding = []
                 hr_hashes_downloading = []
+                non_keep = []
+                keep_active = []
 
-                for t in torrents:
-                    t_hash = t['hash']
-                    if t.get('category') in HR_CATS:
-                        if t.get('progress', 0) >= 1:
+                # 单次遍历种子索引完成分类
+                for t_hash, t in torrents.items():
+                    cat = t['category']
+                    if cat in HR_CATS:
+                        if (t['progress'] or 0) >= 1:
                             hr_hashes_seeding.append(t_hash)
-                            if t_hash not in restore_data:
-                                restore_data[t_hash] = t.get('up_limit', -1)
-                                data_changed = True
+                            if t_hash not in known:
+                                new_limits[t_hash] = t['up_limit'] if t['up_limit'] is not None else -1
                         else:
                             hr_hashes_downloading.append(t_hash)
+                    elif cat in KEEP_CATS:
+                        if t['state'] not in ('stoppedUP', 'stoppedDL', 'pausedUP', 'pausedDL'): keep_active.append(t_hash)
+                    else:
+                        non_keep.append(t_hash)
                 
-                if data_changed:
-                    try:
-                        with open(restore_file, 'w', encoding='utf-8') as f:
-                            json.dump(restore_data, f)
-                    except Exception as e:
-                        logger.error(f"[{name}] Failed to save restore data: {e}")
+                # 原始上传限速与「限速中」标记在修改 qB 之前单独提交，周期写库失败或进程崩溃时不会丢失；
+                # 只要处于限速状态就写入标记：即使没有 HR 种子，恢复逻辑也需要据此触发
+                # 没有新的种子且已有标记时无需写库
+                marked = conn.execute("SELECT 1 FROM restore_marks WHERE server_name=?", (name,)).fetchone()
+                try:
+                    if new_limits or not marked:
+                        with db.write() as wconn: apply_restore(wconn.cursor(), name, {'add': new_limits, 'mark': True})
+                except Exception as e:
+                    # 原始值未保存的种子本周期不限速，下个周期重试
+                    logger.error(f"[{name}] 保存原始上传限速失败: {e}")
+                    hr_hashes_seeding = [h for h in hr_hashes_seeding if h in known]
 
                 if hr_hashes_seeding:
-                    qb_req(ip, "/torrents/setUploadLimit", data={"hashes": "|".join(hr_hashes_seeding), "limit": HR_LIMIT_BYTES})
+                    qb_req(ip, "/torrents/setUploadLimit", data={"hashes": "|".join(hr_hashes_seeding), "limit": HR_LIMIT_BYTES}, deadline=deadline)
                     logger.info(f"[{name}] HR Policy (Seeding): Limited {len(hr_hashes_seeding)} torrents")
 
                 if hr_hashes_downloading:
-                    qb_smart_action(ip, "stop", "|".join(hr_hashes_downloading))
+                    qb_smart_action(ip, "stop", "|".join(hr_hashes_downloading), deadline=deadline)
                     logger.info(f"[{name}] HR Policy (Downloading): Paused {len(hr_hashes_downloading)} torrents")
 
-                non_keep = [t['hash'] for t in torrents if t.get('category') not in KEEP_CATS and t.get('category') not in HR_CATS]
                 if non_keep:
-                    qb_req(ip, "/torrents/delete", data={"hashes": "|".join(non_keep), "deleteFiles": "true"})
+                    qb_req(ip, "/torrents/delete", data={"hashes": "|".join(non_keep), "deleteFiles": "true"}, deadline=deadline)
                     logger.info(f"[{name}] Deleted {len(non_keep)} non-keep torrents")
 
-                keep_active = [t['hash'] for t in torrents if t.get('category') in KEEP_CATS and t.get('category') not in HR_CATS and t.get('state') not in ['stoppedUP', 'stoppedDL', 'pausedUP', 'pausedDL']]
                 if keep_active:
-                    qb_smart_action(ip, "stop", "|".join(keep_active))
+                    qb_smart_action(ip, "stop", "|".join(keep_active), deadline=deadline)
                     logger.info(f"[{name}] Paused {len(keep_active)} keep torrents")
-                
-                # 重要修复：只要处于限速状态，必须保证 restore_file 存在
-                # 即使没有 HR 种子限速数据，文件本身的存在也是“限速中”的标记
-                # 这样恢复逻辑 (if os.path.exists(restore_file)) 才能被触发
-                if not os.path.exists(restore_file):
-                    try:
-                        with open(restore_file, 'w', encoding='utf-8') as f:
-                            json.dump(restore_data, f)
-                    except Exception as e:
-                        logger.error(f"[{name}] Failed to create throttle flag file: {e}")
 
             else:
-                if os.path.exists(restore_file):
+                if conn.execute("SELECT 1 FROM restore_marks WHERE server_name=?", (name,)).fetchone():
                     logger.info(f"[{name}] Detected speed recovery, restoring states...")
                     
                     try:
-                        with open(restore_file, 'r', encoding='utf-8') as f:
-                            restore_data = json.load(f)
-                        
-                        limit_groups = {}
-                        for t_hash, limit in restore_data.items():
-                            if limit not in limit_groups: limit_groups[limit] = []
-                            limit_groups[limit].append(t_hash)
-                        
-                        for limit, hashes in limit_groups.items():
-                            qb_req(ip, "/torrents/setUploadLimit", data={"hashes": "|".join(hashes), "limit": limit})
+                        # 按原始限速分组，每组一次 setUploadLimit
+                        groups = conn.execute("SELECT up_limit, GROUP_CONCAT(hash, '|'), COUNT(*) FROM torrent_restore WHERE server_name=? GROUP BY up_limit", (name,)).fetchall()
+                        for limit, hashes, _ in groups:
+                            qb_req(ip, "/torrents/setUploadLimit", data={"hashes": hashes, "limit": limit}, deadline=deadline)
                             
-                        logger.info(f"[{name}] Restored limits for {len(restore_data)} torrents")
+                        logger.info(f"[{name}] Restored limits for {sum(g[2] for g in groups)} torrents")
                     except Exception as e:
                         logger.error(f"[{name}] Failed to restore limits: {e}")
                     
                     # 修复：使用 resume 替代 start，并恢复所有种子
-                    qb_smart_action(ip, "resume", "all")
+                    qb_smart_action(ip, "resume", "all", deadline=deadline)
                     logger.info(f"[{name}] Resumed all torrents")
                     
-                    try: os.remove(restore_file)
-                    except: pass
-                
+                    # 清除失败时记录保留，下个周期再次执行恢复
+                    try:
+                        with db.write() as wconn: apply_restore(wconn.cursor(), name, {'clear': True})
+                    except Exception as e: logger.error(f"[{name}] 清除恢复记录失败: {e}")
+            metrics.observe('nc_monitor_server_phase_seconds', time.perf_counter() - step_start, server=name, phase='policy')
+        else:
+            metrics.observe('nc_monitor_server_phase_seconds', time.perf_counter() - step_start, server=name, phase='qb')
+        return result
+
+    # 并发检测：周期耗时取决于最慢的一台，而非所有机器耗时之和
+    pool = ThreadPoolExecutor(max_workers=min(MAX_WORKERS, max(1, len(SERVERS))), thread_name_prefix='monitor')
+    futures = {pool.submit(process_server, s): s for s in SERVERS}
+    batches = math.ceil(len(SERVERS) / MAX_WORKERS)
+    done, _ = wait(futures, timeout=batches * SERVER_TIMEOUT + 10)
+    pool.shutdown(wait=False)
+
+    results = []
+    for f, s in futures.items():
+        res = None
+        if f in done:
+            try: res = f.result()
+            except Exception as e: logger.error(f"[{s['name']}] 检测任务异常: {e}")
+        else:
+            f.cancel()
+            logger.error(f"[{s['name']}] 检测超时 (>{SERVER_TIMEOUT}s)，本周期跳过该机器")
+        if res is None:
+            res = {'name': s['name'], 'state': 'low' if vps_status.get(s['ip'], False) else 'high', 'up': None, 'dl': None, 'good_client': None}
+        results.append(res)
+        pending.discard(s['name'])
+        if f in done: poll_scheduler.release(s['name'], res, config)
+        # 超时的机器等其线程真正结束后才释放，保证同一台机器的检测不会重叠
+        else: f.add_done_callback(lambda late, n=s['name']: finish_late(late, n, config))
+
+    mark('qb')
+    changed = record_cycle(results)
+    send_notity = bool(changed)
+    if changed:
+        event_hub.publish('state', {'servers': [{'name': res['name'], 'status': res['state']} for res in results if res['name'] in changed]})
+    # 本轮只检测了部分服务器时，其余服务器沿用各自最近一次的检测结果
+    known = poll_scheduler.results()
+    known.update({res['name']: res for res in results})
+    good_clients = [res['good_client'] for res in known.values() if res['good_client']]
+    metrics.replace('nc_server_throttled', [({'server': n}, 1 if res['state'] == 'low' else 0) for n, res in known.items()])
+    mark('db')
+
     target_rss_ids = config.get("rss_ids", [])
-    if target_rss_ids and config.get("vertex_config", {}).get("use_api_update", True):
-        all_rules = vertex.list_rss_rules()
-        need_restart = False
-        if all_rules:
-            for rule in all_rules:
-                rule_id = str(rule.get('id', ''))
-                if rule_id in target_rss_ids:
-                    current_clients = set(rule.get('clientArr', []))
-                    target_clients = set(good_clients)
-                    if current_clients != target_clients:
-                        logger.info(f"RSS [{rule.get('alias', rule_id)}] 需更新: {len(current_clients)} -> {len(target_clients)}")
-                        rule['clientArr'] = list(target_clients)
-                        rule['enable'] = bool(target_clients)
-                        if vertex.update_rss(rule): logger.info(f"RSS API 更新成功")
-                        else: 
-                            logger.error(f"RSS API 更新失败")
-                            need_restart = True
-        else: logger.warning("无法获取 RSS 规则列表")
-        if need_restart: vertex.restart_container()
+    unknown = [s['name'] for s in config.get("servers", []) if s['name'] not in known]
+    if unknown and target_rss_ids:
+        logger.info(f"尚未检测过的服务器: {', '.join(unknown)}，暂不更新 RSS 规则")
+    elif target_rss_ids and config.get("vertex_config", {}).get("use_api_update", True):
+        vertex_client.configure(config)
+        if not vertex_client.sync_rules([str(i) for i in target_rss_ids], good_clients): vertex_client.restart_container()
+    mark('vertex')
     
-    if send_notity:
-        send_notifications(config)
+    if send_notity: notifier.notify()
+    mark('notify')
+
+    stats_publisher.publish(urgent=bool(changed))
+    mark('stats')
+    metrics.observe('nc_monitor_cycle_seconds', time.perf_counter() - cycle_start)
+    metrics.set('nc_monitor_last_cycle_timestamp', time.time())
 
     logger.info("<<< 检测完成")
 
 scheduler = BackgroundScheduler()
-scheduler.add_job(run_monitor_task, 'interval', minutes=5, id='monitor_job')
-scheduler.start()
+# 每 TICK 秒检查一次到期的服务器；周期较长时允许新的一轮处理其他 (未在检测中的) 服务器
+scheduler.add_job(run_monitor_task, 'interval', seconds=PollScheduler.TICK, id='monitor_job', kwargs={'due_only': True}, max_instances=3, coalesce=True)
+scheduler.add_job(run_compaction, 'cron', hour=4, minute=30, id='compact_job')
+
+# ===================== 多进程部署 (调度选主) =====================
+# gunicorn 多 worker 部署时每个 worker 都会导入本模块：通过 data/ 下的文件锁选出唯一的 leader 运行调度器、
+# 通知队列与压缩任务，其余 worker 只处理网页请求。leader 退出后锁由系统释放，其他 worker 在下一次检查时接管。
+# 非 leader 收到的手动检测请求写入 run_requests 表由 leader 执行；leader 每个周期结束后更新 cycle.stamp，
+# 其余 worker 据此刷新各自的统计快照并向自己的 SSE 订阅者推送。/metrics 与调度诊断接口的数据由 leader
+# 定期写入 leader_state.json，其他 worker 直接返回该内容，抓取落到任一 worker 得到的都是同一组序列
+class LeaderElection:
+    POLL = 2              # 检查锁、转交请求与周期时间戳的间隔 (秒)
+    REQUEST_MAX_AGE = 300 # 超过该时长仍未执行的手动检测请求直接丢弃 (例如期间没有 leader)
+    STATE_EVERY = 15      # leader 写入 leader_state.json 的间隔 (秒)，每个周期结束时也会写入
+    STATE_MAX_AGE = 60    # 超过该时长未更新视为 leader 已退出，改用本进程的数据
+
+    def __init__(self, data_dir):
+        self.lock_file = os.path.join(data_dir, 'scheduler.lock')
+        self.stamp_file = os.path.join(data_dir, 'cycle.stamp')
+        self.state_file = os.path.join(data_dir, 'leader_state.json')
+        self._state_ts = 0
+        self.is_leader = False
+        self._lock = threading.Lock()
+        self._fd = None
+        self._thread = None
+        self._stamp = self._read_stamp()
+        self._config = None
+
+    def _try_lock(self):
+        if fcntl is None: return True  # 不支持 flock 的平台按单进程运行
+        f = open(self.lock_file, 'a+')
+        try: fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        f.seek(0)
+        f.truncate()
+        f.write(f"{os.getpid()}\n")
+        f.flush()
+        self._fd = f  # 保持打开直到进程退出
+        return True
+
+    def _promote(self):
+        self.is_leader = True
+        setup_logging(rotate=True)  # 接管日志文件的按天轮转
+        metrics.set('nc_scheduler_leader', 1)
+        scheduler.start()
+        notifier.start()  # 继续投递上次未发送成功的通知
+        logger.info(f"本进程 (pid {os.getpid()}) 负责运行检测调度")
+
+    def start(self):
+        if self._thread is not None: return
+        if self._try_lock(): self._promote()
+        else: metrics.set('nc_scheduler_leader', 0)
+        self._config = load_config()
+        self._thread = threading.Thread(target=self._run, daemon=True, name='leader')
+        self._thread.start()
+
+    def request_run(self, names=None):
+        # names 为空表示检测全部服务器
+        if self.is_leader:
+            scheduler.add_job(run_monitor_task, kwargs={'only': set(names) if names else None})
+            return
+        with db.write() as conn:
+            conn.execute("INSERT INTO run_requests (servers, created) VALUES (?, ?)", (json.dumps(names or []), time.time()))
+
+    def cycle_done(self):
+        try:
+            with open(self.stamp_file, 'w') as f: f.write(f"{time.time()}\n")
+        except OSError as e: logger.warning(f"更新周期时间戳失败: {e}")
+        self.publish_state()
+
+    def publish_state(self):
+        state = {'ts': time.time(), 'pid': os.getpid(), 'metrics': render_metrics(load_config()),
+                 'schedule': poll_scheduler.stats(), 'qb_sessions': qb_pool.stats(), 'notify_queue': notifier.stats()}
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.state_file), prefix='.leader_state.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f: json.dump(state, f, ensure_ascii=False)
+            os.replace(tmp, self.state_file)
+        except Exception as e:
+            if os.path.exists(tmp): os.remove(tmp)
+            logger.warning(f"写入 leader_state.json 失败: {e}")
+        self._state_ts = state['ts']
+
+    def shared_state(self):
+        # 非 leader 进程读取 leader 最近写入的诊断数据；本进程就是 leader 或数据过期时返回 None
+        if self.is_leader: return None
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f: state = json.load(f)
+        except (OSError, ValueError): return None
+        return state if time.time() - state['ts'] < self.STATE_MAX_AGE else None
+
+    def _read_stamp(self):
+        try: return os.stat(self.stamp_file).st_mtime_ns
+        except OSError: return None
+
+    def _serve_requests(self):
+        rows = db.read().execute("SELECT id, servers, created FROM run_requests ORDER BY id").fetchall()
+        if not rows: return
+        with db.write() as conn: conn.execute("DELETE FROM run_requests WHERE id <= ?", (rows[-1][0],))
+        now = time.time()
+        for _, servers, created in rows:
+            if now - created > self.REQUEST_MAX_AGE: continue
+            names = json.loads(servers)
+            scheduler.add_job(run_monitor_task, kwargs={'only': set(names) if names else None})
+
+    def sync_config(self):
+        # 配置文件变化 (本进程保存或其他 worker 修改)：快照失效，通知本进程的订阅者重新加载
+        with self._lock:
+            config = load_config()
+            if config is self._config: return
+            self._config = config
+        stats_cache.invalidate()
+        event_hub.publish('reload', {})
+
+    def _follow(self):
+        self.sync_config()
+        if self.is_leader: return
+        stamp = self._read_stamp()
+        if stamp != self._stamp:
+            self._stamp = stamp
+            stats_cache.invalidate()
+            event_hub.publish_stats()
+
+    def _run(self):
+        while True:
+            time.sleep(self.POLL)
+            try:
+                if not self.is_leader and self._try_lock(): self._promote()
+                if self.is_leader:
+                    self._serve_requests()
+                    stats_publisher.flush()
+                    if time.time() - self._state_ts >= self.STATE_EVERY: self.publish_state()
+                self._follow()
+            except Exception as e: logger.error(f"调度选主检查失败: {e}")
+
+leader = LeaderElection(DATA_DIR)
+
+# ===================== 应用启动 =====================
+# 导入模块只定义函数与路由；日志文件、密钥、数据库升级与后台调度都在 create_app 中按顺序执行，
+# gunicorn (gunicorn.conf.py 的 wsgi_app) 与 python app.py 都通过它启动
+STARTUP = {}  # 各启动阶段耗时 (秒)
+_startup_lock = threading.Lock()
+
+def create_app(start_scheduler=True):
+    with _startup_lock:
+        if STARTUP: return app
+        STARTUP['import'] = _IMPORT_SECONDS
+        t = time.perf_counter()
+        setup_logging()
+        app.secret_key = load_secret_key()
+        STARTUP['setup'] = time.perf_counter() - t
+        t = time.perf_counter()
+        init_db()
+        STARTUP['db'] = time.perf_counter() - t
+        if start_scheduler:
+            t = time.perf_counter()
+            leader.start()
+            STARTUP['scheduler'] = time.perf_counter() - t
+        metrics.replace('nc_startup_seconds', [({'phase': k}, v) for k, v in STARTUP.items()])
+        logger.info("启动完成: " + ", ".join(f"{k} {v * 1000:.0f} ms" for k, v in STARTUP.items()))
+    return app
+
+_IMPORT_SECONDS = time.perf_counter() - _IMPORT_START
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000)
+    create_app().run(host='0.0.0.0', port=5000)
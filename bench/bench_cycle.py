@@ -0,0 +1,189 @@
+# 端到端基准：合成数据库 + 本地 qB / SOAP / Vertex 替身服务，测量 run_monitor_task 与 /api/stats_advanced
+# 的延迟、吞吐与内存。全部离线运行，不需要真实的 netcup 账号或盒子。
+#
+#   python bench/bench_cycle.py --servers 20 --days 90 --cycles 5
+#   python bench/bench_cycle.py --qb-latency 0.05 --slow-hosts 2 --slow-latency 3 --qb-fail-rate 0.02
+#
+# qB 替身为每台服务器监听一个独立的回环地址 (127.0.x.y)，Linux 下无需额外配置；
+# macOS 需先为这些地址添加 lo0 别名。
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import argparse
+import tempfile
+import resource
+import threading
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synth  # noqa: E402
+import fakes  # noqa: E402
+from synth import app  # noqa: E402
+
+
+def host_ip(i):
+    return f"127.0.{1 + i // 250}.{1 + i % 250}"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values: return 0.0
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def rss_mb():
+    # Linux 下 ru_maxrss 单位为 KB，macOS 为字节
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def use_workdir(workdir, db_path, config):
+    # 把 app 的数据目录、数据库与配置切换到基准用的临时目录；不调用 create_app，调度器不会启动
+    app.app.secret_key = 'bench'
+    app.DATA_DIR = workdir
+    app.WSDL_CACHE_FILE = os.path.join(workdir, 'wsdl_cache.db')
+    app.db = app.Database(db_path)
+    cfg_path = os.path.join(workdir, 'config.json')
+    with open(cfg_path, 'w', encoding='utf-8') as f: json.dump(config, f, ensure_ascii=False)
+    app.config_store = app.ConfigStore(cfg_path)
+    app.leader = app.LeaderElection(workdir)
+    app.leader.is_leader = True  # /metrics 直接读取本进程的指标 (调度器本身不启动)
+    app.stats_cache.invalidate()
+
+
+def phase_sums(client):
+    # 从 /metrics 读取各阶段耗时累计值，周期前后相减得到本轮分布
+    sums = {}
+    for line in client.get('/metrics').get_data(as_text=True).splitlines():
+        if line.startswith('nc_monitor_phase_seconds_sum'):
+            labels, value = line.rsplit(' ', 1)
+            sums[labels.split('"')[1]] = float(value)
+    return sums
+
+
+def bench_cycles(args, client, qb, scp, vertex):
+    print(f"\n== run_monitor_task x {args.cycles} ==")
+    print(f"{'cycle':>6} {'total (ms)':>11} {'qb reqs':>8} {'soap reqs':>10} {'vertex':>7}  phases (ms)")
+    totals, before = [], phase_sums(client)
+    if args.trace_memory: tracemalloc.start()
+    for i in range(args.cycles):
+        counts = (qb.requests, scp.requests, vertex.requests)
+        t = time.perf_counter()
+        app.run_monitor_task()
+        elapsed = time.perf_counter() - t
+        totals.append(elapsed)
+        after = phase_sums(client)
+        phases = ' '.join(f"{k}={(after[k] - before.get(k, 0)) * 1000:.0f}" for k in after)
+        before = after
+        print(f"{i + 1:>6} {elapsed * 1000:>11.1f} {qb.requests - counts[0]:>8} {scp.requests - counts[1]:>10} {vertex.requests - counts[2]:>7}  {phases}")
+    print(f"mean {sum(totals) / len(totals) * 1000:.1f} ms, p50 {percentile(totals, 50) * 1000:.1f} ms, max {max(totals) * 1000:.1f} ms, "
+          f"{args.servers * len(totals) / sum(totals):.1f} servers/s")
+    if args.trace_memory:
+        cur, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"python heap: current {cur / 1024 / 1024:.1f} MB, peak {peak / 1024 / 1024:.1f} MB")
+    print(f"torrent index: {app.torrent_index.stats()}")
+
+
+def bench_stats(args):
+    print(f"\n== /api/stats_advanced x {args.requests} (concurrency {args.concurrency}) ==")
+    print(f"{'mode':>14} {'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9} {'req/s':>8}")
+    local = threading.local()
+
+    def call(mode, is_admin, days):
+        c = getattr(local, 'client', None)
+        if c is None:
+            c = local.client = app.app.test_client()
+            with c.session_transaction() as s: s['logged_in'] = True
+        if mode == 'cold': app.stats_cache.invalidate()
+        t = time.perf_counter()
+        r = c.get(f'/api/stats_advanced?days={days}')
+        assert r.status_code == 200, r.status_code
+        return time.perf_counter() - t
+
+    for mode, days in (('cold', 7), ('snapshot', 7), ('snapshot', 30), ('snapshot', 90)):
+        n = max(args.concurrency, args.requests // 10) if mode == 'cold' else args.requests
+        app.stats_cache.invalidate()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            t = time.perf_counter()
+            lat = list(pool.map(lambda _: call(mode, True, days), range(n)))
+            wall = time.perf_counter() - t
+        label = f"{mode}/{days}d"
+        print(f"{label:>14} {percentile(lat, 50) * 1000:>9.2f} {percentile(lat, 95) * 1000:>9.2f} {percentile(lat, 99) * 1000:>9.2f} {n / wall:>8.0f}")
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description="检测周期与统计接口的离线基准测试")
+    ap.add_argument('--db', help="复用已有的合成数据库 (默认在临时目录生成)")
+    ap.add_argument('--servers', type=int, default=10)
+    ap.add_argument('--days', type=int, default=90, help="合成历史数据的天数")
+    ap.add_argument('--accounts', type=int, default=2, help="SOAP 账号数，服务器平均分配")
+    ap.add_argument('--torrents', type=int, default=500, help="每台 qB 的种子数")
+    ap.add_argument('--churn', type=int, default=5, help="每次 sync 变化的种子数")
+    ap.add_argument('--cycles', type=int, default=5)
+    ap.add_argument('--requests', type=int, default=200, help="/api/stats_advanced 请求数")
+    ap.add_argument('--concurrency', type=int, default=8)
+    ap.add_argument('--qb-latency', type=float, default=0.01)
+    ap.add_argument('--qb-jitter', type=float, default=0.01)
+    ap.add_argument('--qb-fail-rate', type=float, default=0.0)
+    ap.add_argument('--slow-hosts', type=int, default=0, help="前 N 台 qB 使用 --slow-latency")
+    ap.add_argument('--slow-latency', type=float, default=2.0)
+    ap.add_argument('--soap-latency', type=float, default=0.05)
+    ap.add_argument('--soap-fail-rate', type=float, default=0.0)
+    ap.add_argument('--flap-prob', type=float, default=0.05, help="每次查询 vServer 切换限速状态的概率")
+    ap.add_argument('--vertex-latency', type=float, default=0.01)
+    ap.add_argument('--max-workers', type=int, default=8)
+    ap.add_argument('--server-timeout', type=int, default=120)
+    ap.add_argument('--trace-memory', action='store_true', help="使用 tracemalloc 统计 Python 堆峰值 (会拖慢周期)")
+    ap.add_argument('--verbose', action='store_true')
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    workdir = tempfile.mkdtemp(prefix='nc_bench_')
+    path = args.db or os.path.join(workdir, 'monitor.db')
+    if not args.db or not os.path.exists(path):
+        t = time.perf_counter()
+        synth.build_db(path, args.servers, args.days)
+        print(f"生成合成数据库: {path} ({time.perf_counter() - t:.1f}s)")
+    names = synth.server_names(args.servers)
+    ips = [host_ip(i) for i in range(args.servers)]
+
+    qb_port = free_port()
+    qb = fakes.FakeQB(torrents=args.torrents, churn=args.churn, latency=args.qb_latency, jitter=args.qb_jitter, fail_rate=args.qb_fail_rate,
+                      overrides={ip: {'latency': args.slow_latency} for ip in ips[:args.slow_hosts]})
+    qb.start(ips, qb_port)
+    accounts = {100000 + a: ips[a::args.accounts] for a in range(args.accounts)}
+    scp = fakes.FakeSCP(accounts, flap_prob=args.flap_prob, latency=args.soap_latency, fail_rate=args.soap_fail_rate)
+    wsdl = scp.start()
+    vertex = fakes.FakeVertex(latency=args.vertex_latency)
+    vertex_url = vertex.start()
+
+    use_workdir(workdir, path, {
+        'servers': [{'name': n, 'ip': ip, 'client_id': f'client-{i}'} for i, (n, ip) in enumerate(zip(names, ips))],
+        'qb_config': {'port': qb_port, 'user': 'admin', 'password': 'adminadmin'},
+        'keep_categories': ['Keep'],
+        'hr_config': {'categories': ['HR'], 'upload_limit_kb': 10},
+        'soap_config': {'wsdl_url': wsdl, 'accounts': [{'customer_number': acc, 'password': 'x'} for acc in accounts]},
+        'vertex_config': {'api_url': vertex_url, 'api_user': 'admin', 'api_password': 'x', 'use_api_update': True},
+        'rss_ids': list(vertex.rules),
+        'notify_mode': 'none',
+        'monitor_config': {'max_workers': args.max_workers, 'server_timeout': args.server_timeout},
+    })
+    client = app.app.test_client()
+    print(f"{args.servers} servers x {args.torrents} torrents, qB latency {args.qb_latency}+{args.qb_jitter}s, "
+          f"SOAP latency {args.soap_latency}s, {args.slow_hosts} slow hosts, workdir {workdir}")
+
+    bench_cycles(args, client, qb, scp, vertex)
+    bench_stats(args)
+    print(f"\nfailures injected: qB {qb.failures}, SOAP {scp.failures}; Vertex modifies {vertex.modifies}; peak RSS {rss_mb():.0f} MB")
+    for svc in (qb, scp, vertex): svc.stop()
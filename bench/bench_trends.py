@@ -0,0 +1,78 @@
+# get_daily_trends 基准：在一年期合成数据库上对比旧的逐日过滤实现与按桶单次遍历实现
+import os
+import sys
+import time
+import argparse
+import datetime
+import sqlite3
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synth  # noqa: E402
+from synth import app  # noqa: E402
+
+
+def legacy_daily_trends(conn, server_list, days=7):
+    # 旧实现：每台服务器两次查询，并对每一天重新过滤全部样本与事件 (O(天数 x 行数))
+    today = datetime.date.today()
+    dates = [(today - datetime.timedelta(days=i)).strftime('%m-%d') for i in range(days - 1, -1, -1)]
+    trends = {}
+    for s in server_list:
+        name = s['name']
+        trends[name] = {'health': [], 'traffic': []}
+        start = (datetime.datetime.now() - datetime.timedelta(days=days)).timestamp()
+        c = conn.cursor()
+        c.execute("SELECT timestamp, up_total, dl_total FROM traffic_log WHERE server_name=? AND timestamp >= ? ORDER BY timestamp ASC", (name, start))
+        logs = c.fetchall()
+        c.execute("SELECT start_time, end_time FROM state_events WHERE server_name=? AND state='low' AND (end_time >= ? OR end_time IS NULL)", (name, start))
+        events = c.fetchall()
+        for i in range(days - 1, -1, -1):
+            target = today - datetime.timedelta(days=i)
+            day_start = datetime.datetime.combine(target, datetime.time.min).timestamp()
+            day_end = datetime.datetime.combine(target, datetime.time.max).timestamp()
+            day_logs = [l for l in logs if day_start <= l[0] <= day_end]
+            total = 0
+            for j in range(1, len(day_logs)):
+                prev, cur = day_logs[j - 1][1] + day_logs[j - 1][2], day_logs[j][1] + day_logs[j][2]
+                total += cur - prev if cur >= prev else cur
+            trends[name]['traffic'].append(round(total / 1024 / 1024 / 1024, 2))
+            throttled = 0
+            for st, en in events:
+                ov = min(en if en else time.time(), day_end) - max(st, day_start)
+                if ov > 0: throttled += ov
+            trends[name]['health'].append(round(throttled / 3600, 1))
+    return dates, trends
+
+
+def timeit(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t)
+    return best
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description="get_daily_trends 基准测试")
+    ap.add_argument('--db', help="复用已有的合成数据库 (默认在临时目录生成)")
+    ap.add_argument('--servers', type=int, default=10)
+    ap.add_argument('--days', type=int, default=365)
+    ap.add_argument('--repeat', type=int, default=3)
+    args = ap.parse_args()
+
+    path = args.db or os.path.join(tempfile.mkdtemp(prefix='nc_bench_'), 'monitor.db')
+    if not args.db or not os.path.exists(path):
+        t = time.perf_counter()
+        synth.build_db(path, args.servers, args.days)
+        print(f"生成合成数据库: {path} ({time.perf_counter() - t:.1f}s)")
+    conn = sqlite3.connect(path)
+    servers = [{'name': n} for (n,) in conn.execute("SELECT DISTINCT server_name FROM traffic_daily")]
+    rows = conn.execute("SELECT COUNT(*) FROM traffic_log").fetchone()[0]
+    print(f"{len(servers)} servers, {rows} traffic_log rows")
+    print(f"{'window':>8} {'legacy (ms)':>12} {'bucketed (ms)':>14} {'speedup':>8}")
+    for window in app.TREND_WINDOWS:
+        old = timeit(lambda: legacy_daily_trends(conn, servers, window), args.repeat)
+        new = timeit(lambda: app.get_daily_trends(conn, servers, window), args.repeat)
+        print(f"{window:>8} {old * 1000:>12.1f} {new * 1000:>14.2f} {old / new:>7.0f}x")
+    conn.close()
@@ -0,0 +1,319 @@
+# 本地替身服务：qBittorrent WebUI API、netcup SCP SOAP 接口与 Vertex /api/rss/*，
+# 均可注入延迟与失败，用于在没有真实账号 / 盒子的情况下离线测量检测周期
+import json
+import time
+import random
+import secrets
+import threading
+import urllib.parse
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args): pass
+
+    def _dispatch(self):
+        service = self.server.service
+        n = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(n) if n else b''
+        url = urllib.parse.urlparse(self.path)
+        host = self.server.server_address[0]
+        service.requests += 1
+        delay, fail = service.inject(host)
+        if delay: time.sleep(delay)
+        if fail:
+            service.failures += 1
+            return self._reply(*service.failure())
+        code, payload, ctype, headers = service.handle(host, self.command, url.path, urllib.parse.parse_qs(url.query), body, self.headers)
+        self._reply(code, payload, ctype, headers)
+
+    def _reply(self, code, payload, ctype='application/json', headers=None):
+        if not isinstance(payload, bytes):
+            payload = (payload if isinstance(payload, str) else json.dumps(payload, ensure_ascii=False)).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(payload)))
+        for k, v in (headers or {}).items(): self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = _dispatch
+
+
+class FakeService:
+    """
+    替身服务基类。latency 为每个请求的基础延迟 (秒)，jitter 为额外的随机延迟上限，
+    fail_rate 为返回 HTTP 500 的概率；overrides 可按监听地址单独覆盖这三项，
+    用来模拟「一台慢机 / 一台失联」之类的场景。
+    """
+    def __init__(self, latency=0.0, jitter=0.0, fail_rate=0.0, overrides=None, seed=1):
+        self.latency, self.jitter, self.fail_rate = latency, jitter, fail_rate
+        self.overrides = overrides or {}
+        self.requests = self.failures = 0
+        self._rnd = random.Random(seed)
+        self._rnd_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._servers = []
+
+    def inject(self, host):
+        o = self.overrides.get(host, {})
+        with self._rnd_lock:
+            delay = o.get('latency', self.latency) + self._rnd.random() * o.get('jitter', self.jitter)
+            fail = self._rnd.random() < o.get('fail_rate', self.fail_rate)
+        return delay, fail
+
+    def listen(self, host='127.0.0.1', port=0):
+        srv = ThreadingHTTPServer((host, port), _Handler)
+        srv.daemon_threads = True
+        srv.service = self
+        threading.Thread(target=srv.serve_forever, daemon=True, name=f'fake-{type(self).__name__}').start()
+        self._servers.append(srv)
+        return srv.server_address[1]
+
+    def stop(self):
+        for srv in self._servers:
+            srv.shutdown()
+            srv.server_close()
+        self._servers = []
+
+    def failure(self):
+        return 500, 'injected failure', 'text/plain', None
+
+    def handle(self, host, method, path, query, body, headers):
+        raise NotImplementedError
+
+
+class FakeQB(FakeService):
+    """
+    qBittorrent WebUI API v2 替身。每个监听地址 (127.0.x.y) 代表一台盒子，各自维护种子列表与
+    /sync/maindata 的 rid 增量；churn 为每次同步时随机变化的种子数。
+    """
+    CATEGORIES = ('HR', 'Keep', 'misc', 'movie', 'tv')
+
+    def __init__(self, torrents=500, churn=5, **kw):
+        super().__init__(**kw)
+        self.torrents, self.churn = torrents, churn
+        self._hosts = {}
+
+    def start(self, hosts, port):
+        for host in hosts:
+            self._hosts[host] = self._new_host(host)
+            self.listen(host, port)
+
+    def _new_host(self, host):
+        rnd = random.Random(host)
+        torrents = {}
+        for i in range(self.torrents):
+            h = secrets.token_hex(20)
+            torrents[h] = {'name': f'bench.torrent.{i:05d}', 'category': rnd.choice(self.CATEGORIES), 'progress': 1 if rnd.random() < 0.7 else round(rnd.random(), 3),
+                           'state': 'uploading', 'up_limit': -1, 'size': rnd.randint(10**8, 10**11), 'tracker': 'https://tracker.example/announce'}
+        return {'rnd': rnd, 'sids': set(), 'torrents': torrents, 'rid': 0, 'changed': {}, 'removed': set(),
+                'up': rnd.randint(10**11, 10**12), 'dl': rnd.randint(10**10, 10**11)}
+
+    def _touch(self, st, h, **fields):
+        st['torrents'][h].update(fields)
+        st['changed'].setdefault(h, {}).update(fields)
+
+    def handle(self, host, method, path, query, body, headers):
+        st = self._hosts[host]
+        form = {k: v[0] for k, v in urllib.parse.parse_qs(body.decode()).items()}
+        with self._lock:
+            if path.endswith('/auth/login'):
+                sid = secrets.token_hex(16)
+                st['sids'].add(sid)
+                return 200, 'Ok.', 'text/plain', {'Set-Cookie': f'SID={sid}; HttpOnly; path=/'}
+            cookie = headers.get('Cookie') or ''
+            if not any(f'SID={sid}' in cookie for sid in st['sids']):
+                return 403, 'Forbidden', 'text/plain', None
+
+            if path.endswith('/transfer/info'):
+                st['up'] += st['rnd'].randint(0, 300 * 1024 * 1024)
+                st['dl'] += st['rnd'].randint(0, 50 * 1024 * 1024)
+                return 200, {'up_info_data': st['up'], 'dl_info_data': st['dl']}, 'application/json', None
+            if path.endswith('/torrents/info'):
+                return 200, [dict(t, hash=h) for h, t in st['torrents'].items()], 'application/json', None
+            if path.endswith('/sync/maindata'):
+                for h in st['rnd'].sample(list(st['torrents']), min(self.churn, len(st['torrents']))):
+                    t = st['torrents'][h]
+                    if t['progress'] < 1: self._touch(st, h, progress=min(1, round(t['progress'] + 0.1, 3)))
+                rid = int(query.get('rid', ['0'])[0])
+                if rid == 0 or rid != st['rid']:
+                    out = {'full_update': True, 'torrents': st['torrents']}
+                else:
+                    out = {'torrents': st['changed']}
+                    if st['removed']: out['torrents_removed'] = list(st['removed'])
+                st['rid'] += 1
+                out['rid'] = st['rid']
+                payload = json.dumps(out)
+                st['changed'], st['removed'] = {}, set()
+                return 200, payload, 'application/json', None
+
+            hashes = form.get('hashes', '')
+            targets = list(st['torrents']) if hashes == 'all' else [h for h in hashes.split('|') if h in st['torrents']]
+            if path.endswith('/torrents/delete'):
+                for h in targets:
+                    del st['torrents'][h]
+                    st['changed'].pop(h, None)
+                    st['removed'].add(h)
+            elif path.endswith('/torrents/setUploadLimit'):
+                for h in targets: self._touch(st, h, up_limit=int(form.get('limit', -1)))
+            elif path.endswith(('/torrents/stop', '/torrents/pause')):
+                for h in targets: self._touch(st, h, state='stoppedUP' if st['torrents'][h]['progress'] >= 1 else 'stoppedDL')
+            elif path.endswith(('/torrents/start', '/torrents/resume')):
+                for h in targets: self._touch(st, h, state='uploading' if st['torrents'][h]['progress'] >= 1 else 'downloading')
+            else:
+                return 404, 'Not Found', 'text/plain', None
+            return 200, 'Ok.', 'text/plain', None
+
+
+SCP_NS = 'http://enduser.service.web.vcp.netcup.de/'
+
+SCP_WSDL = '''<?xml version="1.0" encoding="UTF-8"?>
+<definitions xmlns="http://schemas.xmlsoap.org/wsdl/" xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/"
+             xmlns:xs="http://www.w3.org/2001/XMLSchema" xmlns:tns="{ns}" targetNamespace="{ns}" name="WSEndUser">
+  <types>
+    <xs:schema targetNamespace="{ns}" elementFormDefault="unqualified">
+      <xs:element name="getVServers" type="tns:getVServers"/>
+      <xs:element name="getVServersResponse" type="tns:getVServersResponse"/>
+      <xs:element name="getVServerInformation" type="tns:getVServerInformation"/>
+      <xs:element name="getVServerInformationResponse" type="tns:getVServerInformationResponse"/>
+      <xs:complexType name="getVServers">
+        <xs:sequence>
+          <xs:element name="loginName" type="xs:string" minOccurs="0"/>
+          <xs:element name="password" type="xs:string" minOccurs="0"/>
+        </xs:sequence>
+      </xs:complexType>
+      <xs:complexType name="getVServersResponse">
+        <xs:sequence><xs:element name="return" type="xs:string" minOccurs="0" maxOccurs="unbounded"/></xs:sequence>
+      </xs:complexType>
+      <xs:complexType name="getVServerInformation">
+        <xs:sequence>
+          <xs:element name="loginName" type="xs:string" minOccurs="0"/>
+          <xs:element name="password" type="xs:string" minOccurs="0"/>
+          <xs:element name="vservername" type="xs:string" minOccurs="0"/>
+        </xs:sequence>
+      </xs:complexType>
+      <xs:complexType name="getVServerInformationResponse">
+        <xs:sequence><xs:element name="return" type="tns:vServer" minOccurs="0"/></xs:sequence>
+      </xs:complexType>
+      <xs:complexType name="vServer">
+        <xs:sequence>
+          <xs:element name="vServerName" type="xs:string" minOccurs="0"/>
+          <xs:element name="ips" type="xs:string" minOccurs="0" maxOccurs="unbounded"/>
+          <xs:element name="serverInterfaces" type="tns:interface" minOccurs="0" maxOccurs="unbounded"/>
+        </xs:sequence>
+      </xs:complexType>
+      <xs:complexType name="interface">
+        <xs:sequence>
+          <xs:element name="mac" type="xs:string" minOccurs="0"/>
+          <xs:element name="trafficThrottled" type="xs:boolean"/>
+        </xs:sequence>
+      </xs:complexType>
+    </xs:schema>
+  </types>
+  <message name="getVServers"><part name="parameters" element="tns:getVServers"/></message>
+  <message name="getVServersResponse"><part name="parameters" element="tns:getVServersResponse"/></message>
+  <message name="getVServerInformation"><part name="parameters" element="tns:getVServerInformation"/></message>
+  <message name="getVServerInformationResponse"><part name="parameters" element="tns:getVServerInformationResponse"/></message>
+  <portType name="WSEndUser">
+    <operation name="getVServers"><input message="tns:getVServers"/><output message="tns:getVServersResponse"/></operation>
+    <operation name="getVServerInformation"><input message="tns:getVServerInformation"/><output message="tns:getVServerInformationResponse"/></operation>
+  </portType>
+  <binding name="WSEndUserPortBinding" type="tns:WSEndUser">
+    <soap:binding transport="http://schemas.xmlsoap.org/soap/http" style="document"/>
+    <operation name="getVServers"><soap:operation soapAction=""/><input><soap:body use="literal"/></input><output><soap:body use="literal"/></output></operation>
+    <operation name="getVServerInformation"><soap:operation soapAction=""/><input><soap:body use="literal"/></input><output><soap:body use="literal"/></output></operation>
+  </binding>
+  <service name="WSEndUser">
+    <port name="WSEndUserPort" binding="tns:WSEndUserPortBinding"><soap:address location="{location}"/></port>
+  </service>
+</definitions>
+'''
+
+
+class FakeSCP(FakeService):
+    """
+    netcup SCP (WSEndUser) SOAP 替身，只实现 getVServers / getVServerInformation。
+    accounts: {customer_number: [ip, ...]}；每次查询时 vServer 以 flap_prob 的概率切换限速状态。
+    """
+    def __init__(self, accounts, flap_prob=0.05, **kw):
+        super().__init__(**kw)
+        self.flap_prob = flap_prob
+        self.vservers = {str(acc): {f'v{acc}-{i}': ip for i, ip in enumerate(ips)} for acc, ips in accounts.items()}
+        self.throttled = {}
+        self.url = None
+
+    def start(self, host='127.0.0.1', port=0):
+        self.url = f"http://{host}:{self.listen(host, port)}/WSEndUser"
+        return self.url + '?wsdl'
+
+    def _envelope(self, op, inner):
+        return (f'<?xml version="1.0" encoding="UTF-8"?><S:Envelope xmlns:S="http://schemas.xmlsoap.org/soap/envelope/"><S:Body>'
+                f'<ns2:{op}Response xmlns:ns2="{SCP_NS}">{inner}</ns2:{op}Response></S:Body></S:Envelope>')
+
+    def _fault(self, text):
+        return (500, f'<?xml version="1.0"?><S:Envelope xmlns:S="http://schemas.xmlsoap.org/soap/envelope/"><S:Body><S:Fault>'
+                     f'<faultcode>S:Server</faultcode><faultstring>{escape(text)}</faultstring></S:Fault></S:Body></S:Envelope>', 'text/xml; charset=utf-8', None)
+
+    def failure(self):
+        return self._fault('injected failure')
+
+    def handle(self, host, method, path, query, body, headers):
+        if method == 'GET':
+            return 200, SCP_WSDL.format(ns=SCP_NS, location=self.url), 'text/xml; charset=utf-8', None
+        call = next(iter(ET.fromstring(body).find('{http://schemas.xmlsoap.org/soap/envelope/}Body')))
+        op = call.tag.rsplit('}', 1)[-1]
+        args = {el.tag.rsplit('}', 1)[-1]: el.text for el in call}
+        servers = self.vservers.get(str(args.get('loginName')))
+        if servers is None: return self._fault('validation error: wrong login')
+        if op == 'getVServers':
+            inner = ''.join(f'<return>{escape(vn)}</return>' for vn in servers)
+        elif op == 'getVServerInformation':
+            vn = args.get('vservername')
+            if vn not in servers: return self._fault('vserver not found')
+            with self._rnd_lock:
+                state = self.throttled.get(vn, False)
+                if self._rnd.random() < self.flap_prob: state = not state
+                self.throttled[vn] = state
+            inner = (f'<return><vServerName>{escape(vn)}</vServerName><ips>{servers[vn]}</ips>'
+                     f'<serverInterfaces><mac>00:00:00:00:00:00</mac><trafficThrottled>{"true" if state else "false"}</trafficThrottled></serverInterfaces></return>')
+        else:
+            return self._fault(f'unknown operation {op}')
+        return 200, self._envelope(op, inner), 'text/xml; charset=utf-8', None
+
+
+class FakeVertex(FakeService):
+    """Vertex 替身：/api/user/login 发放 connect.sid，/api/rss/list 与 /api/rss/modify 读写内存中的 RSS 规则。"""
+    def __init__(self, rules=3, **kw):
+        super().__init__(**kw)
+        self.rules = {str(i): {'id': str(i), 'alias': f'rss-{i}', 'enable': True, 'clientArr': []} for i in range(1, rules + 1)}
+        self.modifies = 0
+        self._sids = set()
+        self.url = None
+
+    def start(self, host='127.0.0.1', port=0):
+        self.url = f"http://{host}:{self.listen(host, port)}"
+        return self.url
+
+    def handle(self, host, method, path, query, body, headers):
+        with self._lock:
+            if path == '/login': return 200, '<html></html>', 'text/html', None
+            if path == '/api/user/login':
+                sid = secrets.token_hex(16)
+                self._sids.add(sid)
+                return 200, {'success': True}, 'application/json', {'Set-Cookie': f'connect.sid={sid}; Path=/; HttpOnly'}
+            cookie = headers.get('Cookie') or ''
+            if not any(f'connect.sid={sid}' in cookie for sid in self._sids):
+                return 200, {'success': False, 'message': '未登录'}, 'application/json', None
+            if path == '/api/rss/list':
+                return 200, {'success': True, 'data': list(self.rules.values())}, 'application/json', None
+            if path == '/api/rss/modify':
+                rule = json.loads(body)
+                self.rules[str(rule['id'])] = rule
+                self.modifies += 1
+                return 200, {'success': True, 'message': '修改 Rss 成功'}, 'application/json', None
+            return 404, 'Not Found', 'text/plain', None
@@ -0,0 +1,84 @@
+# 生成用于基准测试的合成 monitor.db：多台服务器、每 5 分钟一条样本、随机计数器归零与限速抖动
+import os
+import sys
+import time
+import random
+import sqlite3
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+
+def server_names(count):
+    return [f"bench-{i:02d}" for i in range(count)]
+
+
+def _samples(name, start, end, step, reset_prob, rnd):
+    up = dl = rnd.randint(10**9, 10**11)
+    ts = start
+    while ts < end:
+        if rnd.random() < reset_prob:
+            # 模拟 qB 重启：上传/下载计数器同时归零
+            up, dl = 0, 0
+        up += rnd.randint(0, 200 * 1024 * 1024)
+        dl += rnd.randint(0, 50 * 1024 * 1024)
+        yield (name, ts, up, dl, 'high')
+        ts += step
+
+
+def _events(name, start, end, flap_hours, rnd):
+    ts, state = start, 'high'
+    while True:
+        dur = rnd.expovariate(1 / (flap_hours * 3600 if state == 'high' else flap_hours * 900))
+        if ts + dur >= end:
+            yield (name, ts, None, state, None)
+            return
+        yield (name, ts, ts + dur, state, dur)
+        ts += dur
+        state = 'low' if state == 'high' else 'high'
+
+
+def build_db(path, servers=10, days=365, step=300, reset_prob=0.002, flap_hours=36, seed=1):
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix): os.remove(path + suffix)
+    rnd = random.Random(seed)
+    end = time.time()
+    start = end - days * 86400
+
+    old_db, app.DB_FILE = app.DB_FILE, path
+    try:
+        app.init_db()
+    finally:
+        app.DB_FILE = old_db
+
+    conn = sqlite3.connect(path)
+    for name in server_names(servers):
+        conn.executemany("INSERT INTO traffic_log (server_name, timestamp, up_total, dl_total, state) VALUES (?, ?, ?, ?, ?)",
+                         _samples(name, start, end, step, reset_prob, rnd))
+        conn.executemany("INSERT INTO state_events (server_name, start_time, end_time, state, duration) VALUES (?, ?, ?, ?, ?)",
+                         _events(name, start, end, flap_hours, rnd))
+    conn.execute("DELETE FROM traffic_daily")
+    app._backfill_traffic_daily(conn)
+    app._backfill_server_health(conn)
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+    return server_names(servers)
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description="生成合成 monitor.db")
+    ap.add_argument('path')
+    ap.add_argument('--servers', type=int, default=10)
+    ap.add_argument('--days', type=int, default=365)
+    ap.add_argument('--months', type=int, help="按月指定时间跨度 (每月 30 天)，覆盖 --days")
+    ap.add_argument('--step', type=int, default=300, help="样本间隔 (秒)")
+    ap.add_argument('--reset-prob', type=float, default=0.002)
+    ap.add_argument('--flap-hours', type=float, default=36)
+    ap.add_argument('--seed', type=int, default=1)
+    args = ap.parse_args()
+    days = args.months * 30 if args.months else args.days
+    t = time.perf_counter()
+    build_db(args.path, args.servers, days, step=args.step, reset_prob=args.reset_prob, flap_hours=args.flap_hours, seed=args.seed)
+    print(f"{args.path}: {args.servers} servers x {days} days in {time.perf_counter() - t:.1f}s")
@@ -0,0 +1,166 @@
+# 统计计算：今日 / 本月流量、限速时长、趋势与历史速率。只依赖标准库，
+# 工具脚本 (bench/、数据分析) 可以直接导入而不加载 Flask、调度器与 SOAP 客户端
+#
+#   import sqlite3, calc
+#   calc.calculate_traffic(sqlite3.connect('data/monitor.db'), 'my-vps')
+import time
+import math
+import bisect
+import datetime
+
+def counter_delta(prev, cur):
+    # qB 重启后累计计数器会归零，此时本次增量即为当前值
+    return cur if cur < prev else cur - prev
+
+def calculate_traffic(conn, name):
+    now = datetime.datetime.now()
+    m_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0).timestamp()
+    m_day = now.replace(day=1).date().isoformat()
+    t_day = now.date().isoformat()
+    c = conn.cursor()
+    c.execute("SELECT day, up_delta, dl_delta, carry_up, carry_dl, last_up, last_dl FROM traffic_daily WHERE server_name=? AND day >= ? ORDER BY day ASC", (name, m_day))
+    rows = c.fetchall()
+    
+    if rows:
+        cur_u, cur_d = rows[-1][5], rows[-1][6]
+        c.execute("SELECT MIN(first_ts) FROM traffic_daily WHERE server_name=?", (name,))
+        first_ts = c.fetchone()[0] or m_start
+        eff_start = max(m_start, first_ts)
+        delta_days = (now.timestamp() - eff_start) / 86400
+        eff_days = max(1, math.ceil(delta_days))
+        
+        # 本月第一条样本相对上月的增量不计入本月
+        u_mon = sum(r[1] for r in rows) - rows[0][3]
+        d_mon = sum(r[2] for r in rows) - rows[0][4]
+        u_day, d_day = 0, 0
+        if rows[-1][0] == t_day:
+            u_day, d_day = rows[-1][1], rows[-1][2]
+            if len(rows) == 1: u_day -= rows[0][3]; d_day -= rows[0][4]
+            
+        return u_day, d_day, u_mon, d_mon, cur_u, cur_d, u_mon/eff_days, d_mon/eff_days
+    return 0,0,0,0,0,0,0,0
+
+def calculate_health(conn, name):
+    now = time.time()
+    today = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+    c = conn.cursor()
+    
+    c.execute("SELECT state, start_time FROM state_events WHERE server_name=? AND end_time IS NULL ORDER BY id DESC LIMIT 1", (name,))
+    curr = c.fetchone()
+    state = curr[0] if curr else 'unknown'
+    dur = (now - curr[1]) if curr else 0
+    
+    c.execute("SELECT start_time, end_time FROM state_events WHERE server_name=? AND state='low' AND (end_time >= ? OR end_time IS NULL)", (name, today))
+    t_day = sum([min(end or now, now) - max(start, today) for start, end in c.fetchall() if min(end or now, now) > max(start, today)])
+    
+    c.execute("SELECT MIN(first_ts) FROM traffic_daily WHERE server_name=?", (name,))
+    first = c.fetchone()
+    if first and first[0]:
+        days_float = (now - first[0]) / 86400
+        days = max(1, math.ceil(days_float))
+    else:
+        days = 1
+    
+    c.execute("SELECT closed_low FROM server_health WHERE server_name=?", (name,))
+    row = c.fetchone()
+    db_low = row[0] if row else 0
+    all_low = db_low
+    if state == 'low': all_low += dur
+    avg_daily = all_low / days
+    
+    return state, dur, t_day, avg_daily
+
+TREND_WINDOWS = (7, 30, 90)
+
+def get_daily_trends(conn, server_list, days=7):
+    today = datetime.date.today()
+    day_list = [today - datetime.timedelta(days=i) for i in range(days - 1, -1, -1)]
+    dates = [d.strftime('%m-%d') for d in day_list]
+    # bounds[i] ~ bounds[i+1] 为第 i 天的本地时间范围 (按日期计算，兼容夏令时)
+    bounds = [datetime.datetime.combine(d, datetime.time.min).timestamp() for d in day_list]
+    bounds.append(datetime.datetime.combine(today + datetime.timedelta(days=1), datetime.time.min).timestamp())
+    day_index = {d.isoformat(): i for i, d in enumerate(day_list)}
+
+    names = [s['name'] for s in server_list]
+    traffic = {n: [0] * days for n in names}
+    throttled = {n: [0] * days for n in names}
+    if names:
+        marks = ",".join("?" * len(names))
+        c = conn.cursor()
+        # 当天内的流量 = 当日增量减去跨日的第一条增量
+        c.execute(f"SELECT server_name, day, up_delta + dl_delta - carry_up - carry_dl FROM traffic_daily WHERE server_name IN ({marks}) AND day >= ?",
+                  (*names, day_list[0].isoformat()))
+        for name, day, total in c:
+            if day in day_index: traffic[name][day_index[day]] = total
+
+        now = time.time()
+        c.execute(f"SELECT server_name, start_time, end_time FROM state_events WHERE server_name IN ({marks}) AND state='low' AND (end_time >= ? OR end_time IS NULL) AND start_time < ?",
+                  (*names, bounds[0], bounds[-1]))
+        for name, start, end in c:
+            end = end if end else now
+            # 从事件起始所在的那一天开始，只遍历事件实际覆盖的天数
+            i = max(0, bisect.bisect_right(bounds, start) - 1)
+            while i < days and bounds[i] < end:
+                overlap = min(end, bounds[i + 1]) - max(start, bounds[i])
+                if overlap > 0: throttled[name][i] += overlap
+                i += 1
+
+    trends = {n: {'health': [round(t / 3600, 1) for t in throttled[n]],
+                  'traffic': [round(t / 1024 / 1024 / 1024, 2) for t in traffic[n]]} for n in names}
+    return dates, trends
+
+HISTORY_DEFAULT_POINTS = 300
+HISTORY_MAX_POINTS = 1000
+
+def lttb(points, threshold):
+    # Largest-Triangle-Three-Buckets 降采样：保留首尾点，每个桶选出与相邻桶构成最大三角形面积的点，峰谷形状得以保留
+    n = len(points)
+    if threshold >= n or threshold < 3: return points
+    out = [points[0]]
+    every = (n - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        # 下一个桶的平均点作为三角形的第三个顶点
+        nxt_start, nxt_end = int((i + 1) * every) + 1, min(int((i + 2) * every) + 1, n)
+        avg_x = sum(p[0] for p in points[nxt_start:nxt_end]) / (nxt_end - nxt_start)
+        avg_y = sum(p[1] for p in points[nxt_start:nxt_end]) / (nxt_end - nxt_start)
+        ax, ay = points[a]
+        best, best_area = None, -1
+        for j in range(int(i * every) + 1, int((i + 1) * every) + 1):
+            x, y = points[j]
+            area = abs((ax - avg_x) * (y - ay) - (ax - x) * (avg_y - ay))
+            if area > best_area: best, best_area = j, area
+        out.append(points[best])
+        a = best
+    out.append(points[-1])
+    return out
+
+def merge_intervals(intervals, min_gap):
+    # 间隔小于 min_gap (一个显示像素对应的时长) 的相邻区间合并，区间数量不超过目标点数
+    merged = []
+    for start, end in intervals:
+        if merged and start - merged[-1][1] < min_gap: merged[-1][1] = max(merged[-1][1], end)
+        else: merged.append([start, end])
+    return merged
+
+def get_history(conn, name, start, end, points=HISTORY_DEFAULT_POINTS):
+    # 速率 (字节/秒) 由相邻样本的计数器增量计算，计数器归零时按 counter_delta 处理；压缩后的样本间隔更长，结果为该段的平均速率
+    up, dl = [], []
+    prev = conn.execute("SELECT timestamp, up_total, dl_total FROM traffic_log WHERE server_name=? AND timestamp < ? ORDER BY timestamp DESC LIMIT 1", (name, start)).fetchone()
+    for row in conn.execute("SELECT timestamp, up_total, dl_total FROM traffic_log WHERE server_name=? AND timestamp >= ? AND timestamp <= ? ORDER BY timestamp", (name, start, end)):
+        if prev and row[0] > prev[0]:
+            dt = row[0] - prev[0]
+            up.append((row[0], counter_delta(prev[1], row[1]) / dt))
+            dl.append((row[0], counter_delta(prev[2], row[2]) / dt))
+        prev = row
+
+    now = time.time()
+    events = conn.execute("SELECT start_time, end_time FROM state_events WHERE server_name=? AND state='low' AND (end_time >= ? OR end_time IS NULL) AND start_time < ? ORDER BY start_time",
+                          (name, start, end)).fetchall()
+    throttle = merge_intervals([(max(st, start), min(en or now, end)) for st, en in events if min(en or now, end) > max(st, start)], (end - start) / points)
+    return {
+        'server': name, 'start': start, 'end': end, 'samples': len(up),
+        'up': [[round(t, 1), round(v, 1)] for t, v in lttb(up, points)],
+        'dl': [[round(t, 1), round(v, 1)] for t, v in lttb(dl, points)],
+        'throttle': [[round(a, 1), round(b, 1)] for a, b in throttle],
+    }
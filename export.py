@@ -0,0 +1,84 @@
+# 流式导出 traffic_log / state_events (CSV 或 NDJSON)，供 /api/export 与命令行共用
+#
+#   python export.py traffic --server my-vps --start 2025-01-01 --end 2025-02-01 -o traffic.csv
+#   python export.py events --format ndjson > events.ndjson
+#
+# 使用独立的只读连接按批次读取游标，内存占用与导出的时间跨度无关；WAL 模式下不会阻塞检测任务的写入
+import os
+import io
+import sys
+import csv
+import json
+import sqlite3
+import argparse
+import datetime
+
+EXPORT_TABLES = {
+    # 名称: (表, 列, 时间列)
+    'traffic': ('traffic_log', ('server_name', 'timestamp', 'up_total', 'dl_total', 'state'), 'timestamp'),
+    'events': ('state_events', ('server_name', 'start_time', 'end_time', 'state', 'duration'), 'start_time'),
+}
+EXPORT_FORMATS = ('csv', 'ndjson')
+BATCH_ROWS = 2000
+
+
+def parse_time(value):
+    # 接受 unix 时间戳或本地时间的 ISO 日期 / 日期时间 (2025-01-01, 2025-01-01T08:00)；空值返回 None
+    if value in (None, ''): return None
+    try: return float(value)
+    except ValueError: return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def iter_export(db_path, table, fmt='csv', server=None, start=None, end=None):
+    name, cols, ts_col = EXPORT_TABLES[table]
+    where, args = [], []
+    if server:
+        where.append("server_name=?")
+        args.append(server)
+    if start is not None:
+        where.append(f"{ts_col} >= ?")
+        args.append(start)
+    if end is not None:
+        where.append(f"{ts_col} < ?")
+        args.append(end)
+    sql = f"SELECT {', '.join(cols)} FROM {name}" + (f" WHERE {' AND '.join(where)}" if where else "") + f" ORDER BY server_name, {ts_col}"
+
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, timeout=30)
+    try:
+        cur = conn.execute(sql, args)
+        buf = io.StringIO()
+        writer = csv.writer(buf, lineterminator='\n') if fmt == 'csv' else None
+        if writer:
+            writer.writerow(cols)
+            yield buf.getvalue()
+        while True:
+            rows = cur.fetchmany(BATCH_ROWS)
+            if not rows: break
+            buf.seek(0)
+            buf.truncate()
+            if writer: writer.writerows(rows)
+            else: buf.writelines(json.dumps(dict(zip(cols, row)), ensure_ascii=False) + '\n' for row in rows)
+            yield buf.getvalue()
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description="导出流量样本 (traffic) 或限速事件 (events)")
+    ap.add_argument('table', choices=sorted(EXPORT_TABLES))
+    ap.add_argument('--format', choices=EXPORT_FORMATS, default='csv')
+    ap.add_argument('--server', help="只导出指定服务器")
+    ap.add_argument('--start', help="起始时间 (unix 时间戳或 ISO 日期，含)")
+    ap.add_argument('--end', help="结束时间 (unix 时间戳或 ISO 日期，不含)")
+    ap.add_argument('--db', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'monitor.db'))
+    ap.add_argument('-o', '--output', help="输出文件 (默认标准输出)")
+    args = ap.parse_args()
+    try: start, end = parse_time(args.start), parse_time(args.end)
+    except ValueError: ap.error("--start / --end 须为 unix 时间戳或 ISO 日期 (如 2025-01-01 或 2025-01-01T08:00)")
+
+    out = open(args.output, 'w', encoding='utf-8', newline='') if args.output else sys.stdout
+    try:
+        for chunk in iter_export(args.db, args.table, args.format, args.server, start, end):
+            out.write(chunk)
+    finally:
+        if args.output: out.close()
@@ -0,0 +1,18 @@
+# 生产模式: gunicorn -c gunicorn.conf.py
+#
+# 每个 worker 独立导入 app.py，由 data/scheduler.lock 选出唯一运行检测调度的进程，其余 worker 只处理网页请求。
+# SSE (/api/events) 长连接各占用一个线程，每个 worker 最多接受 3/4 线程数的 SSE 连接，其余面板改为定时轮询
+import os
+
+wsgi_app = 'app:create_app()'
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get('WEB_WORKERS', '2'))
+worker_class = 'gthread'
+# 写回环境变量：worker 据此计算 SSE 连接上限 (见 app.sse_subscriber_limit)
+threads = int(os.environ.setdefault('WEB_THREADS', '32'))
+timeout = 60
+graceful_timeout = 10
+# 不能预加载：预加载会在 master 进程中抢到调度锁并启动线程，而线程不会随 fork 进入 worker
+preload_app = False
+accesslog = None
+errorlog = '-'